@@ -0,0 +1,588 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SMS Receiver 压测脚本
+
+stress: 在临时目录中启动若干 sms_receiver 进程（共享同一份存储），并发推送短信后校验数据完整性；
+        --devices N 时用 N 个设备 Key 推送，每台设备写入自己的分区
+suite:  按不同存储规模预置短信，测量各接口的吞吐、p50/p99 延迟和峰值内存，每项结果输出一行 JSON
+scale:  用 gunicorn 启动器分别以 1、2、4… 个工作进程运行，测量推送与查询吞吐随进程数的变化
+extract: 测量入库时提取验证码 / 签名 / 分类的单条耗时
+load:   按不同存储规模预置短信后，在新进程中测量首次打开存储（取第一页）的耗时与增加的常驻内存
+
+用法:
+    python3 sms_bench.py stress --requests 5000 --concurrency 64 --workers 4
+    python3 sms_bench.py stress --requests 5000 --concurrency 64 --workers 4 --devices 4
+    python3 sms_bench.py suite --sizes 1000,10000,100000 --backend json,sqlite,packed --mode inproc,http
+    python3 sms_bench.py scale --workers 1,2,4 --requests 5000 --concurrency 64
+    python3 sms_bench.py extract --messages 100000
+    python3 sms_bench.py load --sizes 10000,100000 --backend json,packed
+"""
+
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import sms_receiver
+
+BENCH_HOST = "127.0.0.1"
+BENCH_PORT = 32100
+BENCH_API_KEY = "bench-key"
+
+
+def device_key(i):
+    return f"{BENCH_API_KEY}-dev{i}"
+
+
+def configure(data_dir, max_entries, backend="json", devices=0):
+    """让 sms_receiver 使用临时目录中的存储；devices 大于 0 时按设备分区"""
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    sms_receiver.API_KEY = BENCH_API_KEY
+    sms_receiver.app.secret_key = "bench-secret"
+    sms_receiver.limiter.rate = 0   # 压测从同一来源高速推送，不限速
+    if devices:
+        sms_receiver.DEVICES = {device_key(i): f"dev{i}" for i in range(devices)}
+        sms_receiver.STORAGE_BACKEND = backend
+        sms_receiver.SMS_LOG_FILE = os.path.join(data_dir, "sms_log.json")
+        sms_receiver.SMS_WAL_FILE = os.path.join(data_dir, "sms_log.wal")
+        sms_receiver.SQLITE_DB_FILE = os.path.join(data_dir, "sms_log.db")
+        sms_receiver.PACKED_LOG_FILE = os.path.join(data_dir, "sms_log.pack")
+        sms_receiver.PACKED_WAL_FILE = os.path.join(data_dir, "sms_log.pack.wal")
+        sms_receiver.SMS_ID_FILE = os.path.join(data_dir, "sms_log.lastid")
+        sms_receiver.MAX_LOG_ENTRIES = sms_receiver.SQLITE_MAX_ENTRIES = sms_receiver.PACKED_MAX_ENTRIES = max_entries
+        sms_receiver.ARCHIVE_DIR = ""
+        sms_receiver.store = sms_receiver.create_store()
+    elif backend == "sqlite":
+        sms_receiver.store = sms_receiver.SqliteLogStore(os.path.join(data_dir, "sms_log.db"), max_entries)
+    elif backend == "packed":
+        sms_receiver.store = sms_receiver.PackedLogStore(
+            os.path.join(data_dir, "sms_log.pack"),
+            os.path.join(data_dir, "sms_log.pack.wal"),
+            max_entries,
+        )
+    else:
+        sms_receiver.store = sms_receiver.LogStore(
+            os.path.join(data_dir, "sms_log.json"),
+            os.path.join(data_dir, "sms_log.wal"),
+            max_entries,
+        )
+    return sms_receiver.store
+
+
+def serve(data_dir, max_entries, port, backend="json", devices=0):
+    """子进程入口：启动一个多线程 HTTP 服务"""
+    from werkzeug.serving import make_server
+    configure(data_dir, max_entries, backend, devices)
+    make_server(BENCH_HOST, port, sms_receiver.app, threaded=True).serve_forever()
+
+
+def serve_gunicorn(data_dir, max_entries, port, backend, workers, threads):
+    """子进程入口：通过 sms_receiver 的 gunicorn 启动器运行（本进程即 gunicorn master）"""
+    configure(data_dir, max_entries, backend)
+    sms_receiver.run_server("gunicorn", BENCH_HOST, port, workers, threads)
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection(BENCH_HOST, port, timeout=1)
+            conn.request("GET", "/health")
+            conn.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"服务未能在 {timeout} 秒内启动: {port}")
+
+
+def start_servers(data_dir, max_entries, workers, backend="json", devices=0):
+    procs = []
+    for i in range(workers):
+        p = multiprocessing.Process(target=serve, args=(data_dir, max_entries, BENCH_PORT + i, backend, devices),
+                                    daemon=True)
+        p.start()
+        procs.append(p)
+    for i in range(workers):
+        wait_for_port(BENCH_PORT + i)
+    return procs
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def post_many(n, concurrency, workers, devices=0):
+    """并发推送 n 条短信，返回 (成功的 id 列表, 失败数, 各请求耗时)；devices 大于 0 时各连接轮流使用设备 Key"""
+    keys = [device_key(i) for i in range(devices)] or [BENCH_API_KEY]
+
+    def worker(indexes):
+        port = BENCH_PORT + indexes[0] % workers
+        key = keys[indexes[0] % len(keys)]
+        conn = http.client.HTTPConnection(BENCH_HOST, port, timeout=30)
+        ids, errors, latencies = [], 0, []
+        for i in indexes:
+            body = json.dumps({"sender": f"1069{i % 97:04d}", "message": f"【压测】您的验证码是 {i:06d}，5 分钟内有效。",
+                               "timestamp": f"{i}"})
+            start = time.perf_counter()
+            try:
+                conn.request("POST", "/sms", body, {"Content-Type": "application/json", "X-API-Key": key})
+                resp = conn.getresponse()
+                data = json.loads(resp.read())
+            except (OSError, http.client.HTTPException, ValueError):
+                conn.close()
+                conn = http.client.HTTPConnection(BENCH_HOST, port, timeout=30)
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+            if resp.status == 200 and data.get("status") == "ok":
+                ids.append(data["id"])
+            else:
+                errors += 1
+        conn.close()
+        return ids, errors, latencies
+
+    chunks = [list(range(c, n, concurrency)) for c in range(concurrency)]
+    ids, errors, latencies = [], 0, []
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for chunk_ids, chunk_errors, chunk_latencies in pool.map(worker, [c for c in chunks if c]):
+            ids.extend(chunk_ids)
+            errors += chunk_errors
+            latencies.extend(chunk_latencies)
+    return ids, errors, latencies
+
+
+def get_many(n, concurrency, path):
+    """并发发送 n 个 GET 请求，返回 (失败数, 各请求耗时)"""
+    def worker(count):
+        conn = http.client.HTTPConnection(BENCH_HOST, BENCH_PORT, timeout=30)
+        errors, latencies = 0, []
+        for _ in range(count):
+            start = time.perf_counter()
+            try:
+                conn.request("GET", path, headers={"X-API-Key": BENCH_API_KEY})
+                resp = conn.getresponse()
+                resp.read()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection(BENCH_HOST, BENCH_PORT, timeout=30)
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+            errors += resp.status != 200
+        conn.close()
+        return errors, latencies
+
+    counts = [n // concurrency + (1 if i < n % concurrency else 0) for i in range(concurrency)]
+    errors, latencies = 0, []
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for chunk_errors, chunk_latencies in pool.map(worker, [c for c in counts if c]):
+            errors += chunk_errors
+            latencies.extend(chunk_latencies)
+    return errors, latencies
+
+
+def cmd_stress(args):
+    data_dir = tempfile.mkdtemp(prefix="sms_bench_")
+    procs = start_servers(data_dir, args.requests * 2, args.workers, devices=args.devices)
+    try:
+        start = time.perf_counter()
+        ids, errors, latencies = post_many(args.requests, args.concurrency, args.workers, args.devices)
+        elapsed = time.perf_counter() - start
+    finally:
+        for p in procs:
+            p.terminate()
+            p.join()
+
+    # 用全新的存储实例从磁盘读取，确认每个返回过的 id 都已持久化
+    configure(data_dir, args.requests * 2, devices=args.devices)
+    stored = sms_receiver.store.load()
+    stored_ids = {l["id"] for l in stored}
+    missing = [i for i in ids if i not in stored_ids]
+    result = {
+        "benchmark": "stress",
+        "workers": args.workers,
+        "devices": args.devices,
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "acked": len(ids),
+        "errors": errors,
+        "stored": len(stored),
+        "missing": len(missing),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(ids) / elapsed, 1) if elapsed else 0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+    print(json.dumps(result, ensure_ascii=False))
+    if not args.keep:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    return 0 if not missing and len(stored) == len(ids) and not errors else 1
+
+
+# ==================== 基准测试 ====================
+
+BRANDS = ["淘宝", "京东", "支付宝", "微信支付", "美团", "拼多多", "抖音", "滴滴出行", "12306", "顺丰速运"]
+BANKS = ["招商银行", "工商银行", "建设银行", "中国银行", "农业银行", "交通银行"]
+SENDERS = ["106575000", "106980095", "1069070069", "95555", "95588", "95533", "10690000", "+8613800138000",
+           "+8613912345678", "10086", "10010", "1065502"]
+
+
+def fake_sms(rng):
+    """生成一条接近真实分布的中文短信"""
+    kind = rng.random()
+    if kind < 0.5:
+        brand = rng.choice(BRANDS)
+        return (rng.choice(SENDERS), f"【{brand}】您的验证码是{rng.randint(0, 999999):06d}，"
+                                     f"{rng.choice([5, 10, 15])}分钟内有效，请勿泄露给他人。")
+    if kind < 0.75:
+        bank = rng.choice(BANKS)
+        return (rng.choice(["95555", "95588", "95533", "95566"]),
+                f"【{bank}】您尾号{rng.randint(0, 9999):04d}的账户于{rng.randint(1, 12)}月{rng.randint(1, 28)}日"
+                f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}消费人民币{rng.randint(1, 99999) / 100:.2f}元，"
+                f"可用余额{rng.randint(100, 9999999) / 100:.2f}元。")
+    if kind < 0.9:
+        brand = rng.choice(BRANDS)
+        return (rng.choice(SENDERS), f"【{brand}】双十一狂欢节提前购！全场满{rng.choice([199, 299, 399])}减"
+                                     f"{rng.choice([30, 50, 80])}，限时{rng.randint(1, 3)}天，点击 t.cn/{rng.randint(10 ** 5, 10 ** 6)} 领取，回T退订")
+    return (f"+86139{rng.randint(0, 99999999):08d}", "晚上一起吃饭吗？我在公司楼下等你，大概七点到。")
+
+
+def seed(target, size, rng):
+    """预置 size 条短信（分批写入），返回写入的 id 列表"""
+    ids = []
+    for start in range(0, size, 10000):
+        batch = []
+        for i in range(start, min(size, start + 10000)):
+            sender, message = fake_sms(rng)
+            batch.append({"id": None, "sender": sender, "message": message, "pdu_timestamp": "",
+                          "received_at": "2026-01-01 00:00:00", "client_ip": "127.0.0.1"})
+        target.extend(batch)
+        ids.extend(r["id"] for r in batch)
+    target.compact()
+    return ids
+
+
+class InProcessClient:
+    """通过 Flask test client 调用（不经过网络）"""
+
+    def __init__(self):
+        self.client = sms_receiver.app.test_client()
+        with self.client.session_transaction() as sess:
+            sess["logged_in"] = True
+            sess["username"] = "bench"
+
+    def request(self, method, path, body=None):
+        resp = self.client.open(path, method=method, json=body, headers={"X-API-Key": BENCH_API_KEY})
+        data = resp.get_data()
+        return resp.status_code, data
+
+
+class HttpClient:
+    """通过真实 HTTP（keep-alive）调用本地服务"""
+
+    def __init__(self, port):
+        self.port = port
+        self.conn = http.client.HTTPConnection(BENCH_HOST, port, timeout=120)
+        self.cookie = None
+        body = f"username={sms_receiver.WEB_USER}&password={sms_receiver.WEB_PASS}"
+        _, _, headers = self._send("POST", "/login", body, "application/x-www-form-urlencoded")
+        self.cookie = (headers.get("Set-Cookie") or "").split(";")[0]
+
+    def _send(self, method, path, body, content_type):
+        headers = {"X-API-Key": BENCH_API_KEY}
+        if content_type:
+            headers["Content-Type"] = content_type
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        self.conn.request(method, path, body, headers)
+        resp = self.conn.getresponse()
+        return resp.status, resp.read(), resp.headers
+
+    def request(self, method, path, body=None):
+        payload = json.dumps(body, ensure_ascii=False).encode("utf-8") if body is not None else None
+        status, data, _ = self._send(method, path, payload, "application/json" if body is not None else None)
+        return status, data
+
+
+def peak_rss_kb(pid=None):
+    """峰值常驻内存（KB）；pid 为子进程时读取 /proc 中的 VmHWM"""
+    if pid is None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def measure(client, op, count, make_request):
+    """执行 count 次请求，返回统计结果"""
+    latencies, errors = [], 0
+    start = time.perf_counter()
+    for i in range(count):
+        method, path, body = make_request(i)
+        t0 = time.perf_counter()
+        status, _ = client.request(method, path, body)
+        latencies.append(time.perf_counter() - t0)
+        if status >= 400:
+            errors += 1
+    elapsed = time.perf_counter() - start
+    return {
+        "op": op,
+        "requests": count,
+        "errors": errors,
+        "throughput_rps": round(count / elapsed, 1) if elapsed else 0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+def run_ops(client, size, ids, rng, args):
+    """依次测量各接口；删除放在最后，因为它会改变存储内容"""
+    n = args.requests
+    heavy = max(1, min(n, args.heavy_requests))
+    mid_id = ids[len(ids) // 2] if ids else 0
+    ops = [
+        ("ingest", n, lambda i: ("POST", "/sms", dict(zip(("sender", "message"), fake_sms(rng)),
+                                                      timestamp=f"bench-{size}-{i}"))),
+        ("list_recent", n, lambda i: ("GET", "/sms?limit=50", None)),
+        ("list_sender", n, lambda i: ("GET", f"/sms?sender={rng.choice(SENDERS)}&limit=50", None)),
+        ("list_sender_exact", n, lambda i: ("GET", f"/sms?sender={rng.choice(SENDERS)}&exact=1&limit=50", None)),
+        ("list_deep_offset", n, lambda i: ("GET", f"/sms?limit=50&offset={max(size - 100, 0)}", None)),
+        ("list_cursor", n, lambda i: ("GET", f"/sms?before_id={mid_id}&limit=50", None)),
+        ("search", n, lambda i: ("GET", f"/sms/search?q={urllib.parse.quote(rng.choice(BRANDS))}&limit=20", None)),
+        ("latest_code", n, lambda i: ("GET", "/sms/latest-code", None)),
+        ("stats", n, lambda i: ("GET", "/api/stats", None)),
+        ("health", n, lambda i: ("GET", "/health", None)),
+        ("dashboard", heavy, lambda i: ("GET", "/", None)),
+        # 首页只输出页面框架，列表由前端分页请求；首屏 = dashboard + dashboard_page
+        ("dashboard_page", n, lambda i: ("GET", "/api/sms/list?limit=50&before_id=", None)),
+        ("dashboard_page_deep", n, lambda i: ("GET", f"/api/sms/list?limit=50&before_id={mid_id}", None)),
+        ("export_selected", heavy, lambda i: ("POST", "/api/sms/export", {"ids": rng.sample(ids, min(1000, len(ids)))})),
+        ("export_all", heavy, lambda i: ("POST", "/api/sms/export", {"format": "ndjson"})),
+    ]
+    chunk = max(1, min(args.delete_batch, len(ids) // max(heavy, 1)))
+    ops.append(("delete_batch", heavy,
+                lambda i: ("POST", "/api/sms/delete", {"ids": ids[i * chunk:(i + 1) * chunk]})))
+    selected = [o for o in ops if not args.ops or o[0] in args.ops]
+    return [measure(client, name, count, make) for name, count, make in selected]
+
+
+def cmd_suite(args):
+    sizes = [int(s) for s in args.sizes.split(",")]
+    backends = args.backend.split(",")
+    modes = args.mode.split(",")
+    out = open(args.output, "a", encoding="utf-8") if args.output else None
+    failed = False
+    for backend in backends:
+        for size in sizes:
+            for mode in modes:
+                data_dir = tempfile.mkdtemp(prefix="sms_bench_")
+                rng = random.Random(size)
+                max_entries = size * 2 + args.requests * 10
+                target = configure(data_dir, max_entries, backend)
+                t0 = time.perf_counter()
+                ids = seed(target, size, rng)
+                seed_s = time.perf_counter() - t0
+                procs = []
+                try:
+                    if mode == "http":
+                        procs = start_servers(data_dir, max_entries, 1, backend)
+                        client = HttpClient(BENCH_PORT)
+                    else:
+                        client = InProcessClient()
+                    results = run_ops(client, size, ids, rng, args)
+                    rss = peak_rss_kb(procs[0].pid if procs else None)
+                finally:
+                    for p in procs:
+                        p.terminate()
+                        p.join()
+                    shutil.rmtree(data_dir, ignore_errors=True)
+                for result in results:
+                    failed = failed or result["errors"] > 0
+                    line = json.dumps(dict({"benchmark": "suite", "backend": backend, "mode": mode, "size": size,
+                                            "seed_s": round(seed_s, 3), "peak_rss_kb": rss}, **result),
+                                      ensure_ascii=False)
+                    print(line, flush=True)
+                    if out:
+                        out.write(line + "\n")
+    if out:
+        out.close()
+    return 1 if failed else 0
+
+
+def cmd_scale(args):
+    failed = False
+    for workers in [int(w) for w in args.workers.split(",")]:
+        data_dir = tempfile.mkdtemp(prefix="sms_bench_")
+        max_entries = args.requests * 2
+        proc = multiprocessing.Process(target=serve_gunicorn, daemon=True,
+                                       args=(data_dir, max_entries, BENCH_PORT, args.backend, workers, args.threads))
+        proc.start()
+        try:
+            wait_for_port(BENCH_PORT, timeout=30)
+            start = time.perf_counter()
+            ids, ingest_errors, ingest_latencies = post_many(args.requests, args.concurrency, 1)
+            ingest_s = time.perf_counter() - start
+            start = time.perf_counter()
+            query_errors, query_latencies = get_many(args.requests, args.concurrency, "/sms?limit=50")
+            query_s = time.perf_counter() - start
+        finally:
+            proc.terminate()  # SIGTERM：gunicorn 优雅退出
+            proc.join()
+            shutil.rmtree(data_dir, ignore_errors=True)
+        failed = failed or ingest_errors > 0 or query_errors > 0
+        print(json.dumps({
+            "benchmark": "scale",
+            "backend": args.backend,
+            "workers": workers,
+            "threads": args.threads,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "errors": ingest_errors + query_errors,
+            "ingest_rps": round(len(ids) / ingest_s, 1) if ingest_s else 0,
+            "ingest_p50_ms": round(percentile(ingest_latencies, 50) * 1000, 2),
+            "ingest_p99_ms": round(percentile(ingest_latencies, 99) * 1000, 2),
+            "query_rps": round(len(query_latencies) / query_s, 1) if query_s else 0,
+            "query_p50_ms": round(percentile(query_latencies, 50) * 1000, 2),
+            "query_p99_ms": round(percentile(query_latencies, 99) * 1000, 2),
+        }, ensure_ascii=False), flush=True)
+    return 1 if failed else 0
+
+
+def cmd_extract(args):
+    rng = random.Random(0)
+    messages = [fake_sms(rng)[1] for _ in range(args.messages)]
+    extract = sms_receiver.extractor.extract
+    categories = {}
+    for message in messages:   # 预热，顺便统计分类分布
+        category = extract(message)["category"]
+        categories[category] = categories.get(category, 0) + 1
+    best = None
+    for _ in range(args.rounds):
+        start = time.perf_counter()
+        for message in messages:
+            extract(message)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(json.dumps({
+        "benchmark": "extract",
+        "messages": len(messages),
+        "rounds": args.rounds,
+        "us_per_message": round(best / len(messages) * 1e6, 3),
+        "messages_per_s": round(len(messages) / best, 1) if best else 0,
+        "categories": categories,
+    }, ensure_ascii=False))
+    return 0
+
+
+def current_rss_kb():
+    """当前常驻内存（KB），读取 /proc/self/status 中的 VmRSS"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def open_store(data_dir, max_entries, backend, results):
+    """子进程入口：打开已有存储并取第一页，报告耗时与常驻内存增量"""
+    rss_before = current_rss_kb()
+    start = time.perf_counter()
+    target = configure(data_dir, max_entries, backend)
+    count = target.count()
+    target.recent(50)
+    load_s = time.perf_counter() - start
+    rss_after = current_rss_kb()
+    results.put({"count": count, "load_ms": round(load_s * 1000, 2),
+                 "rss_delta_kb": rss_after - rss_before if rss_before and rss_after else None})
+
+
+def cmd_load(args):
+    ctx = multiprocessing.get_context("fork")
+    for backend in args.backend.split(","):
+        for size in [int(s) for s in args.sizes.split(",")]:
+            data_dir = tempfile.mkdtemp(prefix="sms_bench_")
+            try:
+                ids = seed(configure(data_dir, size, backend), size, random.Random(size))
+                snapshot_bytes = sum(os.path.getsize(os.path.join(data_dir, name)) for name in os.listdir(data_dir))
+                results = ctx.Queue()
+                proc = ctx.Process(target=open_store, args=(data_dir, size, backend, results))
+                proc.start()
+                result = results.get(timeout=600)
+                proc.join()
+            finally:
+                shutil.rmtree(data_dir, ignore_errors=True)
+            print(json.dumps(dict({"benchmark": "load", "backend": backend, "size": len(ids),
+                                   "disk_bytes": snapshot_bytes}, **result), ensure_ascii=False), flush=True)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SMS Receiver 压测")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("stress", help="并发推送并校验没有丢失短信")
+    p.add_argument("--requests", type=int, default=5000, help="推送条数")
+    p.add_argument("--concurrency", type=int, default=64, help="并发连接数")
+    p.add_argument("--workers", type=int, default=4, help="服务进程数")
+    p.add_argument("--devices", type=int, default=0, help="设备数；大于 0 时每台设备一个存储分区")
+    p.add_argument("--keep", action="store_true", help="保留临时数据目录")
+    p.set_defaults(func=cmd_stress)
+
+    p = sub.add_parser("suite", help="按存储规模测量各接口的吞吐与延迟")
+    p.add_argument("--sizes", default="1000,10000,100000", help="预置条数，逗号分隔（如 1000,10000,100000,1000000）")
+    p.add_argument("--backend", default="json", help="存储后端，逗号分隔：json,sqlite,packed")
+    p.add_argument("--mode", default="inproc", help="调用方式，逗号分隔：inproc（test client）,http（本地服务）")
+    p.add_argument("--requests", type=int, default=200, help="轻量接口每项请求数")
+    p.add_argument("--heavy-requests", type=int, default=10, help="首页、导出、删除每项请求数")
+    p.add_argument("--delete-batch", type=int, default=1000, help="每次批量删除的 id 数")
+    p.add_argument("--ops", type=lambda v: v.split(","), default=None, help="只运行指定项目，逗号分隔")
+    p.add_argument("--output", help="结果追加写入的文件（JSON Lines）")
+    p.set_defaults(func=cmd_suite)
+
+    p = sub.add_parser("scale", help="用 gunicorn 按不同工作进程数测量推送与查询吞吐")
+    p.add_argument("--workers", default="1,2,4", help="工作进程数，逗号分隔")
+    p.add_argument("--threads", type=int, default=sms_receiver.THREADS, help="每个工作进程的线程数")
+    p.add_argument("--backend", default="json", help="存储后端：json / sqlite / packed")
+    p.add_argument("--requests", type=int, default=5000, help="推送与查询各自的请求数")
+    p.add_argument("--concurrency", type=int, default=64, help="并发连接数")
+    p.set_defaults(func=cmd_scale)
+
+    p = sub.add_parser("extract", help="测量短信字段提取（验证码 / 签名 / 分类）的单条耗时")
+    p.add_argument("--messages", type=int, default=100000, help="短信条数")
+    p.add_argument("--rounds", type=int, default=3, help="重复轮数，取最快一轮")
+    p.set_defaults(func=cmd_extract)
+
+    p = sub.add_parser("load", help="测量首次打开存储的耗时与常驻内存随规模的变化")
+    p.add_argument("--sizes", default="10000,100000", help="预置条数，逗号分隔")
+    p.add_argument("--backend", default="json,packed", help="存储后端，逗号分隔：json,sqlite,packed")
+    p.set_defaults(func=cmd_load)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
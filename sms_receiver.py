@@ -6,81 +6,2709 @@ SMS Forwarder 服务端
 支持 API Key 验证、Web 登录、短信管理功能
 """
 
-from flask import Flask, request, jsonify, render_template_string, Response, session, redirect, url_for
+from flask import Flask, request, jsonify, render_template, Response, session, redirect, url_for, g
+from werkzeug.exceptions import RequestEntityTooLarge
 from datetime import datetime, timezone, timedelta
+from array import array
+from bisect import bisect_left, bisect_right
 from functools import wraps
+from contextlib import contextmanager, nullcontext
+from collections import OrderedDict, deque
+from itertools import islice
+from operator import itemgetter
+import argparse
+import csv
+import glob
+import gzip
+import http.client
+import io
 import json
 import os
 import logging
+import math
+import mmap
+import queue
+import re
 import hashlib
+import heapq
+import importlib.util
 import secrets
+import signal
+import sys
+import sqlite3
+import struct
+import threading
+import time
+import urllib.parse
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，只使用进程内锁
+    fcntl = None
 
 # ==================== 配置区 ====================
-SMS_LOG_FILE = "sms_log.json"       # 短信存储文件
-MAX_LOG_ENTRIES = 1000              # 最多保留条数，防止文件过大
+SMS_LOG_FILE = "sms_log.json"       # 短信存储文件（快照）
+SMS_WAL_FILE = "sms_log.wal"        # 追加写日志，每条短信一行 JSON
+MAX_LOG_ENTRIES = 1000              # 在线库最多保留条数，超出的旧记录移入归档
+RETENTION_MAX_AGE_DAYS = 0          # 在线库最长保留天数，超出移入归档；0 表示不限
+RETENTION_MAX_BYTES = 0             # 在线库记录总大小上限（字节，按 JSON 估算），超出移入归档；0 表示不限
+ARCHIVE_DIR = "sms_archive"         # 归档目录（按月 gzip 分段）；设为空字符串则过期记录直接丢弃
+COMPACT_INTERVAL = 60               # 后台合并 WAL 到快照、执行保留策略的间隔（秒）
+STORAGE_BACKEND = "json"            # 存储后端：json（默认）/ sqlite / packed
+SQLITE_DB_FILE = "sms_log.db"       # SQLite 数据库文件（STORAGE_BACKEND = "sqlite" 时使用）
+SQLITE_MAX_ENTRIES = 0              # SQLite 在线库最多保留条数（走索引，不受 JSON 快照大小限制）；0 表示不限
+PACKED_LOG_FILE = "sms_log.pack"    # 紧凑二进制快照（STORAGE_BACKEND = "packed" 时使用，按需解码，适合大量历史记录）
+PACKED_WAL_FILE = "sms_log.pack.wal"  # packed 后端的追加写日志
+PACKED_MAX_ENTRIES = 0              # packed 在线库最多保留条数；0 表示不限
+SMS_STATS_FILE = "sms_log.stats.json"  # 统计计数表（/api/stats）的检查点，重启后与存储一致时直接加载，不必逐条重建
+DEDUP_TTL = 600                     # 重复推送判定窗口（秒），覆盖 ESP32 的重试周期；0 表示不去重
+DEDUP_MAX_KEYS = 10000              # 去重表最多保留的键数
+EXTRACT_CODE_PATTERNS = []          # 额外的验证码正则（第一个分组为验证码），优先于内置规则
+EXTRACT_CATEGORY_RULES = []         # 额外的分类规则 [(分类, 正则)]，优先于内置规则
+BATCH_MAX_ITEMS = 100               # POST /sms/batch 单次最多条数
+MAX_CONTENT_LENGTH = 1024 * 1024    # 请求体上限（字节），超出时不读取请求体直接返回 413
+MAX_MESSAGE_LENGTH = 4096           # 单条短信内容最大字符数
+RATE_LIMIT_PER_SECOND = 1           # 每个设备的推送速率（条/秒，按 X-Device-Id，缺省按来源 IP）；0 表示不限速
+RATE_LIMIT_BURST = 30               # 令牌桶容量：设备重连后可以连续推送的条数
+RATE_LIMIT_STATE_FILE = ""          # 限流状态共享文件（SQLite），多 worker 共用一个桶；为空时每个进程各自在内存中计数
+FEED_BACKLOG = 1000                 # 推送通道在内存中保留的最近短信条数
+LONG_POLL_MAX_WAIT = 60             # 长轮询最长等待（秒）
+FORWARD_WEBHOOKS = []               # 收到短信后转发的地址，元素为 URL 或 {"url": ..., "format": "json" / "wecom"}
+FORWARD_WORKERS = 4                 # 转发线程数
+FORWARD_QUEUE_SIZE = 1000           # 内存转发队列上限，满了转入重试队列，不阻塞接收
+FORWARD_TIMEOUT = 15                # 单次转发超时（秒）
+FORWARD_MAX_RETRIES = 5             # 最多重试次数
+FORWARD_RETRY_BASE = 5              # 重试退避基数（秒），第 n 次重试等待 base * 2^(n-1)
+FORWARD_RETRY_FILE = "forward_retry.jsonl"  # 持久化的转发重试队列
 API_KEY = "your-api-key-here"       # API密钥（ESP32 推送时使用）
+DEVICES = {}                        # 设备 API Key -> 设备 id，如 {"key-of-box1": "box1"}；配置后每台设备的短信单独存储（API_KEY 对应 default 分区）
+SMS_ID_FILE = "sms_log.lastid"      # 多设备分区共享的 id 计数文件，保证各分区分配的 id 全局唯一
 WEB_USER = "admin"                  # Web 登录用户名
 WEB_PASS = "change-me"              # Web 登录密码
 HOST = "0.0.0.0"                    # 监听地址
 PORT = 32000                        # 监听端口
-SECRET_KEY = secrets.token_hex(32)  # Session 密钥
+SERVER = "auto"                     # 运行方式：auto（依次尝试 gunicorn、waitress）/ gunicorn / waitress / dev（Flask 开发服务器）
+WORKERS = 2                         # gunicorn 工作进程数
+THREADS = 16                        # 每个工作进程的线程数，每个 SSE / 长轮询连接占用一个线程
+STREAM_MAX_CONNECTIONS = 8          # 每个进程同时保持的 SSE / 长轮询连接上限，须小于 THREADS，为接收短信留出线程
+GRACEFUL_TIMEOUT = 30               # 收到 SIGTERM 后等待进行中请求完成的最长时间（秒）
+SECRET_KEY = ""                     # Session 密钥；为空时使用 SECRET_KEY_FILE 中的密钥，重启和多 worker 间共享
+SECRET_KEY_FILE = "secret_key"      # 自动生成的 Session 密钥文件，相对路径以本脚本所在目录为准（首次启动时生成）
 # ================================================
 
-# 中国时区 (UTC+8)
-CHINA_TZ = timezone(timedelta(hours=8))
+# 中国时区 (UTC+8)
+CHINA_TZ = timezone(timedelta(hours=8))
+
+
+def load_secret_key(path):
+    """读取保存的 Session 密钥，不存在或为空时生成
+
+    新密钥先完整写入临时文件再 link 到目标位置，目标文件一旦出现内容就是完整的；
+    多个进程同时启动时只有一个能 link 成功，其余进程读取它写入的密钥。
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            key = f.read().strip()
+        if key:
+            return key
+    except FileNotFoundError:
+        pass
+    key = secrets.token_hex(32)
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(key)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            os.replace(tmp_file, path)  # 旧文件为空（如写入时崩溃），直接覆盖
+        else:
+            os.link(tmp_file, path)
+    except FileExistsError:
+        return load_secret_key(path)  # 其他进程先写入了
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return key
+
+
+app = Flask(__name__)
+app.secret_key = SECRET_KEY or None  # 未配置时由 main() 从 SECRET_KEY_FILE 读取
+app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+
+# 配置日志
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s [%(levelname)s] %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+logger = logging.getLogger(__name__)
+
+
+def get_china_time():
+    """获取中国时间"""
+    return datetime.now(CHINA_TZ).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def next_sms_id(last_id):
+    """生成短信 id：毫秒时间戳，且保证大于 last_id（同一毫秒内依次加一）"""
+    return max(int(time.time() * 1000), last_id + 1)
+
+
+def verify_api_key():
+    """验证 API Key（用于 ESP32 推送），通过时把对应的设备 id 记在 g.device
+
+    DEVICES 中的 Key 对应各自的设备；API_KEY 不绑定设备（g.device 为空字符串）。
+    """
+    key = request.headers.get('X-API-Key') or request.args.get('api_key')
+    if key and key in DEVICES:
+        g.device = DEVICES[key]
+        return True
+    if not API_KEY or key == API_KEY:
+        g.device = ''
+        return True
+    return False
+
+
+def login_required(f):
+    """Web 页面登录验证装饰器"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not session.get('logged_in'):
+            return redirect(url_for('login'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+# ==================== 运行指标 ====================
+
+class Metrics:
+    """进程内计数器与直方图，/metrics 以 Prometheus 文本格式输出
+
+    多 worker 部署时每个进程各自统计，由 Prometheus 按实例汇总。
+    """
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}     # (name, labels) -> 值
+        self._histograms = {}   # (name, labels) -> [各桶计数..., 超出最大桶的计数, 总和, 次数]
+        self._help = {}
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [0] * (len(self.BUCKETS) + 3)
+            hist[bisect_left(self.BUCKETS, value)] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ''
+        return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items) + '}'
+
+    def render(self, gauges=()):
+        """输出文本格式；gauges 为抓取时现算的 (name, 值, labels) 列表"""
+        lines, typed = [], set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                if name in self._help:
+                    lines.append(f'# HELP {name} {self._help[name]}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((k, list(v)) for k, v in self._histograms.items())
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        for (name, labels), hist in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS, hist):
+                cumulative += count
+                lines.append(f'{name}_bucket{self._labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_bucket{self._labels(labels, [("le", "+Inf")])} {hist[-1]}')
+            lines.append(f'{name}_sum{self._labels(labels)} {hist[-2]}')
+            lines.append(f'{name}_count{self._labels(labels)} {hist[-1]}')
+        for name, value, labels in gauges:
+            header(name, 'gauge')
+            lines.append(f'{name}{self._labels(sorted(labels.items()))} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('http_request_duration_seconds', '按路由统计的请求耗时')
+metrics.describe('sms_ingested_total', '入库短信数（按来源 IP）')
+metrics.describe('sms_duplicates_total', '被去重忽略的重复推送数（按来源 IP）')
+metrics.describe('sms_store_load_seconds', '从磁盘加载记录的耗时')
+metrics.describe('sms_store_save_seconds', '写入存储的耗时')
+metrics.describe('sms_store_bytes_written_total', '写入存储文件的字节数')
+metrics.describe('sms_archived_total', '按保留策略移入归档的短信数')
+metrics.describe('sms_store_cache_total', '内存缓存命中情况：hit 直接命中，tail 只读取 WAL 新增部分，miss 全量重载')
+
+
+# ==================== 全文索引 ====================
+
+class SearchIndex:
+    """短信全文索引（发送者 + 内容）
+
+    文本转小写后切成字符 2-gram，中文无需分词即可检索；倒排表为按写入顺序追加的 id 数组。
+    查询时取最短的倒排表作为候选，再用子串匹配确认，按命中次数（发送者命中加权）和 id 倒序排序。
+    写入和删除时增量更新；首次查询时才从存储全量构建。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings = {}     # gram -> array('q') of id
+        self._docs = {}         # id -> (sender, message)，均为小写
+        self._stale = 0         # 已删除文档在倒排表中残留的条目数
+        self._live = 0
+        self.built = False
+
+    @staticmethod
+    def tokenize(text):
+        """切分为字符 2-gram（不足两个字符时返回原文）"""
+        if len(text) < 2:
+            return {text} if text else set()
+        return {text[i:i + 2] for i in range(len(text) - 1)}
+
+    def _add(self, record):
+        sms_id = record.get('id')
+        if sms_id in self._docs:
+            return
+        doc = ((record.get('sender') or '').lower(), (record.get('message') or '').lower())
+        self._docs[sms_id] = doc
+        grams = self.tokenize(doc[0]) | self.tokenize(doc[1])
+        for gram in grams:
+            postings = self._postings.get(gram)
+            if postings is None:
+                postings = self._postings[gram] = array('q')
+            postings.append(sms_id)
+        self._live += len(grams)
+
+    def _remove(self, record):
+        doc = self._docs.pop(record.get('id'), None)
+        if doc is None:
+            return
+        grams = len(self.tokenize(doc[0]) | self.tokenize(doc[1]))
+        self._live -= grams
+        self._stale += grams
+        if self._stale > self._live:
+            self._rebuild_postings()
+
+    def _rebuild_postings(self):
+        docs = self._docs
+        self._postings, self._docs, self._stale, self._live = {}, {}, 0, 0
+        for sms_id, (sender, message) in docs.items():
+            self._add({'id': sms_id, 'sender': sender, 'message': message})
+
+    def rebuild(self, records):
+        """用全部记录重建索引"""
+        with self._lock:
+            self._postings, self._docs, self._stale, self._live = {}, {}, 0, 0
+            for record in records:
+                self._add(record)
+            self.built = True
+
+    def on_add(self, records):
+        with self._lock:
+            if self.built:
+                for record in records:
+                    self._add(record)
+
+    def on_delete(self, records):
+        with self._lock:
+            if self.built:
+                for record in records:
+                    self._remove(record)
+
+    def on_reset(self, records):
+        if self.built:
+            self.rebuild(records)
+
+    def ranked(self, query):
+        """返回全部命中的 (得分, id)，按得分、id 倒序；多个关键词以空格分隔，需全部命中"""
+        terms = [t for t in query.lower().split() if t]
+        if not terms:
+            return []
+        with self._lock:
+            candidates = None
+            for term in terms:
+                if len(term) == 1:
+                    postings = [p for g, p in self._postings.items() if term in g]
+                    size = sum(len(p) for p in postings)
+                else:
+                    postings = [self._postings.get(g, ()) for g in self.tokenize(term)]
+                    postings = [min(postings, key=len)]
+                    size = len(postings[0])
+                if candidates is None or size < candidates[0]:
+                    candidates = (size, postings)
+            scored, seen = [], set()
+            for postings in candidates[1]:
+                for sms_id in postings:
+                    if sms_id in seen:
+                        continue
+                    seen.add(sms_id)
+                    doc = self._docs.get(sms_id)
+                    if doc is None:
+                        continue
+                    score = 0
+                    for term in terms:
+                        hits = doc[1].count(term) + (2 if term in doc[0] else 0)
+                        if not hits:
+                            break
+                        score += hits
+                    else:
+                        scored.append((score, sms_id))
+        scored.sort(reverse=True)
+        return scored
+
+
+# ==================== 新短信推送 ====================
+
+class SmsFeed:
+    """新短信推送通道（SSE / 长轮询）
+
+    作为存储的派生索引挂在写路径上：写入时把新记录放进有界缓冲并唤醒所有等待者，
+    订阅方只在内存中等待，不轮询存储。其他进程写入的短信在 sync 时同样会发布。
+    """
+
+    def __init__(self, backlog=FEED_BACKLOG):
+        self._cond = threading.Condition()
+        self._recent = deque(maxlen=backlog)  # id 递增
+        self.closed = False
+
+    def on_add(self, records):
+        with self._cond:
+            self._recent.extend(records)
+            self._cond.notify_all()
+
+    def on_delete(self, records):
+        ids = {r.get('id') for r in records}
+        with self._cond:
+            self._recent = deque((r for r in self._recent if r.get('id') not in ids), maxlen=self._recent.maxlen)
+
+    def on_reset(self, records):
+        with self._cond:
+            self._recent.clear()
+
+    def close(self):
+        """服务退出时唤醒并结束所有等待者"""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def wait(self, since_id, timeout):
+        """等待 id 大于 since_id 的新短信，返回 (记录列表, 是否完整)
+
+        超时或通道关闭时记录列表为空；缓冲已满且最早一条也比 since_id 新时，中间可能有被挤出的短信，完整为 False。
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self.closed or (self._recent and self._recent[-1].get('id', 0) > since_id),
+                                timeout)
+            records = [r for r in self._recent if r.get('id', 0) > since_id]
+            complete = len(self._recent) < self._recent.maxlen or self._recent[0].get('id', 0) <= since_id
+            return records, complete
+
+
+# ==================== 重复推送去重 ====================
+
+class DedupCache:
+    """重复推送判定：去重键 -> 首次入库的短信 id（有界 LRU + TTL）
+
+    作为存储的派生索引挂在写路径上：其他 worker 写入的记录在存储写锁内同步进来，
+    因此在写锁内做检查时，重试落到哪个 worker 都能识别。显式的 Idempotency-Key 随记录保存，
+    重启后从最近的记录重建即可恢复。
+    """
+
+    def __init__(self, ttl, max_keys):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (id, 过期时间)
+        self.built = False
+
+    @staticmethod
+    def key_of(record):
+        """记录的去重键：优先用 Idempotency-Key，否则按 (发送者, 内容, PDU 时间戳) 计算"""
+        if record.get('idempotency_key'):
+            return 'key:' + record['idempotency_key']
+        return dedup_key(record.get('sender'), record.get('message'), record.get('pdu_timestamp'))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, sms_id):
+        with self._lock:
+            self._entries[key] = (sms_id, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+
+    def rebuild(self, records):
+        """用最近的记录（按接收顺序）重建，只保留 TTL 窗口内的"""
+        since = (datetime.now(CHINA_TZ) - timedelta(seconds=self.ttl)).strftime('%Y-%m-%d %H:%M:%S')
+        with self._lock:
+            self._entries.clear()
+        for record in records[-self.max_keys:]:
+            key = self.key_of(record)
+            if key and record.get('received_at', '') >= since:
+                self.put(key, record.get('id'))
+        self.built = True
+
+    def on_add(self, records):
+        if self.built:
+            for record in records:
+                key = self.key_of(record)
+                if key:
+                    self.put(key, record.get('id'))
+
+    def on_delete(self, records):
+        pass  # 已删除短信的重试仍按重复处理
+
+    def on_reset(self, records):
+        if self.built:
+            self.rebuild(records)
+
+    def check(self, records):
+        """返回与 records 一一对应的原记录（同一批内更早的记录，或 {"id": 已入库的 id}），不重复时为 None"""
+        originals, pending = [], {}
+        for record in records:
+            key = self.key_of(record)
+            original = None
+            if key:
+                original = pending.get(key)
+                if original is None:
+                    sms_id = self.get(key)
+                    if sms_id is not None:
+                        original = {"id": sms_id}
+                if original is None:
+                    pending[key] = record
+            originals.append(original)
+        return originals
+
+
+def dedup_key(sender, message, timestamp):
+    """按 (发送者, 内容, PDU 时间戳) 计算去重键；没有 PDU 时间戳时无法区分重试与新短信，返回 None"""
+    if not timestamp:
+        return None
+    raw = json.dumps([sender, message, timestamp], ensure_ascii=False)
+    return 'sha1:' + hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+# ==================== 短信解析 ====================
+
+class SmsExtractor:
+    """入库时从短信内容提取结构化字段：验证码（code）、签名（brand，【…】中的内容）、分类（category）
+
+    正则在构造时编译一次，可以通过 EXTRACT_CODE_PATTERNS / EXTRACT_CATEGORY_RULES 在内置规则之前插入自定义规则。
+    验证码依次尝试各条正则，取第一个命中；有验证码的短信分类为 otp，否则按分类规则顺序取第一条命中，都不命中为 other。
+    """
+
+    CODE_KEYWORDS = r'(?:验证码|校验码|动态码|动态密码|确认码|安全码|激活码|verification code|security code|code|otp)'
+    CODE_VALUE = r'((?=[A-Za-z]*[0-9])[A-Za-z0-9]{4,8})'     # 4-8 位，至少含一个数字
+    CODE_PATTERNS = [
+        # 验证码是 123456 / code: 123456 / 验证码为：A1B2C3
+        CODE_KEYWORDS + r'\s*(?:是|为|is|:|：)?\s*[:：]?\s*' + CODE_VALUE + r'(?![A-Za-z0-9])',
+        # 123456 是您的验证码 / 123456 is your verification code
+        r'(?<![A-Za-z0-9])' + CODE_VALUE + r'\s*(?:是|为|is)\s*(?:您的|你的|your)?\s*[^，,。\n]{0,12}?' + CODE_KEYWORDS,
+    ]
+    CATEGORY_RULES = [
+        ('bank', r'银行|信用卡|储蓄卡|借记卡|尾号\d{4}|余额|入账|转账|还款'),
+        ('delivery', r'快递|取件|驿站|包裹|丰巢|派送|运单'),
+        ('marketing', r'退订|回T|回TD|拒收请回复|优惠|促销|红包|满\d+减|领取'),
+    ]
+    BRAND_PATTERN = r'^\s*【([^】]{1,24})】|【([^】]{1,24})】\s*$'
+
+    def __init__(self, code_patterns=(), category_rules=()):
+        flags = re.IGNORECASE
+        self.code_patterns = [re.compile(p, flags) for p in list(code_patterns) + self.CODE_PATTERNS]
+        self.category_rules = [(c, re.compile(p, flags)) for c, p in list(category_rules) + self.CATEGORY_RULES]
+        self.brand_pattern = re.compile(self.BRAND_PATTERN)
+
+    def extract(self, message):
+        """返回提取出的字段：category 总是存在，code / brand 只在提取到时存在"""
+        fields = {}
+        match = self.brand_pattern.search(message)
+        if match:
+            fields['brand'] = match.group(1) or match.group(2)
+        for pattern in self.code_patterns:
+            match = pattern.search(message)
+            if match:
+                fields['code'] = match.group(1)
+                fields['category'] = 'otp'
+                return fields
+        fields['category'] = next((c for c, pattern in self.category_rules if pattern.search(message)), 'other')
+        return fields
+
+    def fields_of(self, record):
+        """记录中已有的提取字段；旧记录没有时现场提取"""
+        if 'category' in record:
+            return {k: record[k] for k in ('code', 'brand', 'category') if k in record}
+        return self.extract(record.get('message') or '')
+
+
+extractor = SmsExtractor(EXTRACT_CODE_PATTERNS, EXTRACT_CATEGORY_RULES)
+
+
+class CodeIndex:
+    """最新验证码索引：发送者 -> 最近几条带验证码的短信（按 id 递增）
+
+    作为存储的派生索引挂在写路径上，GET /sms/latest-code 直接从内存回答；首次查询时才从存储构建。
+    每个发送者只保留最近 per_sender 条，删除把某个发送者的记录删空时标记为未构建，下次查询重建。
+    """
+
+    def __init__(self, per_sender=8):
+        self.per_sender = per_sender
+        self._lock = threading.Lock()
+        self._codes = {}    # 发送者 -> deque[记录（含提取字段）]
+        self.built = False
+
+    def _add(self, record):
+        fields = extractor.fields_of(record)
+        if not fields.get('code'):
+            return
+        codes = self._codes.get(record.get('sender'))
+        if codes is None:
+            codes = self._codes[record.get('sender')] = deque(maxlen=self.per_sender)
+        codes.append(dict(record, **fields))
+
+    def rebuild(self, records):
+        with self._lock:
+            self._codes = {}
+            for record in records:
+                self._add(record)
+            self.built = True
+
+    def on_add(self, records):
+        with self._lock:
+            if self.built:
+                for record in records:
+                    self._add(record)
+
+    def on_delete(self, records):
+        ids = {r.get('id') for r in records}
+        with self._lock:
+            for sender in {r.get('sender') for r in records}:
+                codes = self._codes.get(sender)
+                if codes is None:
+                    continue
+                kept = [r for r in codes if r.get('id') not in ids]
+                if len(kept) < len(codes) and not kept:
+                    self.built = False     # 更早的验证码没有保留，下次查询时重建
+                codes.clear()
+                codes.extend(kept)
+
+    def on_reset(self, records):
+        if self.built:
+            self.rebuild(records)
+
+    def latest(self, sender=None, brand=None, since=None):
+        """最新一条带验证码的短信，可按发送者（精确匹配）、签名和最早接收时间过滤；没有时返回 None"""
+        with self._lock:
+            groups = [self._codes.get(sender, ())] if sender else list(self._codes.values())
+            best = None
+            for codes in groups:
+                for record in reversed(codes):
+                    if brand and record.get('brand') != brand:
+                        continue
+                    if best is None or record.get('id', 0) > best.get('id', 0):
+                        best = record
+                    break
+        if best is not None and since and best.get('received_at', '') < since:
+            return None
+        return best
+
+
+# ==================== 统计汇总 ====================
+
+class SmsStats:
+    """短信统计：总数、按发送者 / 设备计数、按小时 / 天的分桶计数
+
+    作为存储的派生索引在写路径上增量维护（新增加一、删除减一、整体重载时重建），
+    GET /api/stats 只遍历计数表，耗时与桶数有关、与短信条数无关；首次查询时才构建。
+    path 不为空时由后台维护线程定期写入检查点，重启后首次构建时若检查点记下的条数与最新 id
+    与存储一致（id 单调递增，新增必然使最新 id 变大）则直接加载，否则逐条重建。
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._reset()
+        self.built = False
+        self._dirty = False
+
+    def _reset(self):
+        self.total = 0
+        self.last_id = 0
+        self.senders = {}   # 发送者 -> 条数
+        self.hours = {}     # 'YYYY-MM-DD HH' -> 条数
+        self.days = {}      # 'YYYY-MM-DD' -> 条数
+        self.devices = {}   # 设备 id -> {'YYYY-MM-DD HH': 条数}
+
+    @staticmethod
+    def _bump(counts, key, delta):
+        value = counts.get(key, 0) + delta
+        if value > 0:
+            counts[key] = value
+        else:
+            counts.pop(key, None)
+
+    def _count(self, record, delta):
+        received_at = record.get('received_at') or ''
+        hour = received_at[:13]
+        self.total += delta
+        self._bump(self.senders, record.get('sender') or '', delta)
+        self._bump(self.hours, hour, delta)
+        self._bump(self.days, received_at[:10], delta)
+        device = record.get('device') or DEFAULT_DEVICE
+        hours = self.devices.setdefault(device, {})
+        self._bump(hours, hour, delta)
+        if not hours:
+            del self.devices[device]
+        if delta > 0:
+            self.last_id = max(self.last_id, record.get('id') or 0)
+
+    def _restore(self, count, last_id):
+        """加载与 (count, last_id) 一致的检查点，成功时返回 True"""
+        if not self.path:
+            return False
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if saved.get('total') != count or saved.get('last_id') != last_id:
+            return False
+        self.total, self.last_id = count, last_id
+        self.senders, self.hours, self.days = saved['senders'], saved['hours'], saved['days']
+        self.devices = saved['devices']
+        return True
+
+    def rebuild(self, records):
+        with self._lock:
+            last_id = record_id(records[-1]) if len(records) else 0
+            if self.built or not self._restore(len(records), last_id):
+                self._reset()
+                for record in records:
+                    self._count(record, 1)
+                self._dirty = True
+            self.built = True
+
+    def on_add(self, records):
+        with self._lock:
+            if self.built:
+                for record in records:
+                    self._count(record, 1)
+                self._dirty = True
+
+    def on_delete(self, records):
+        with self._lock:
+            if self.built:
+                for record in records:
+                    self._count(record, -1)
+                self._dirty = True
+
+    def on_reset(self, records):
+        if self.built:
+            self.rebuild(records)
+
+    def save(self):
+        """写入检查点（原子替换），自上次写入后没有变化时不写"""
+        with self._lock:
+            if not (self.path and self.built and self._dirty):
+                return
+            data = json.dumps({"total": self.total, "last_id": self.last_id, "senders": self.senders,
+                               "hours": self.hours, "days": self.days, "devices": self.devices},
+                              ensure_ascii=False)
+            self._dirty = False
+        tmp_file = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_file, self.path)
+
+    def snapshot(self):
+        """当前计数表的副本"""
+        with self._lock:
+            return {"total": self.total, "senders": dict(self.senders), "hours": dict(self.hours),
+                    "days": dict(self.days), "devices": {d: dict(h) for d, h in self.devices.items()}}
+
+
+STATS_MAX_HOURS = 24 * 93     # /api/stats 单次最多返回的小时桶数
+STATS_MAX_DAYS = 3660         # /api/stats 单次最多返回的天桶数
+
+
+def merge_counts(counts_list):
+    """合并多个计数表；只有一个非空时直接返回它"""
+    non_empty = [counts for counts in counts_list if counts]
+    if len(non_empty) <= 1:
+        return non_empty[0] if non_empty else {}
+    merged = dict(non_empty[0])
+    for counts in non_empty[1:]:
+        for key, value in counts.items():
+            merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+def summarize_stats(snapshots, hours=24, days=30, top=20, now=None):
+    """把一个或多个分区的 SmsStats.snapshot() 合并成 /api/stats 的响应内容
+
+    hourly / daily 为截至 now 的最近 hours 小时 / days 天（没有短信的桶为 0），
+    devices 中 last_hour / last_24h 为最近 1 / 24 个小时桶的条数，rate_per_hour 为最近 24 小时的平均值。
+    """
+    now = now or datetime.now(CHINA_TZ)
+    senders = merge_counts([snap['senders'] for snap in snapshots])
+    hour_counts = merge_counts([snap['hours'] for snap in snapshots])
+    day_counts = merge_counts([snap['days'] for snap in snapshots])
+    devices = {}
+    for snap in snapshots:
+        for device, device_hours in snap['devices'].items():
+            devices[device] = merge_counts([devices.get(device, {}), device_hours])
+    hour_keys = [(now - timedelta(hours=i)).strftime('%Y-%m-%d %H') for i in range(max(hours, 24) - 1, -1, -1)]
+    day_keys = [(now - timedelta(days=i)).strftime('%Y-%m-%d') for i in range(max(days, 0) - 1, -1, -1)]
+    device_rows = []
+    for device in sorted(devices):
+        counts = devices[device]
+        last_24h = sum(counts.get(key, 0) for key in hour_keys[-24:])
+        device_rows.append({"device": device, "total": sum(counts.values()), "last_hour": counts.get(hour_keys[-1], 0),
+                            "last_24h": last_24h, "rate_per_hour": round(last_24h / 24, 2)})
+    return {
+        "total": sum(snap['total'] for snap in snapshots),
+        "sender_count": len(senders),
+        "senders": [{"sender": sender, "count": count}
+                    for sender, count in heapq.nlargest(max(top, 0), senders.items(), key=itemgetter(1))],
+        "hourly": [{"hour": key, "count": hour_counts.get(key, 0)} for key in hour_keys[len(hour_keys) - max(hours, 0):]],
+        "daily": [{"day": key, "count": day_counts.get(key, 0)} for key in day_keys],
+        "devices": device_rows,
+    }
+
+# ==================== 存储引擎 ====================
+
+class BaseStore:
+    """存储后端公共部分：后台维护线程、派生索引"""
+
+    compact_interval = COMPACT_INTERVAL
+    max_age_days = 0    # 按时间的保留上限（天），0 表示不限
+    max_bytes = 0       # 按大小的保留上限（字节），0 表示不限
+    partitions = {}     # 设备 id -> 分区存储，只有 PartitionedStore 有
+
+    def __init__(self):
+        self.archive = None     # SmsArchive，为 None 时过期记录直接丢弃
+        self.id_source = None   # SmsIdAllocator，多个分区共享；为 None 时只保证本存储内唯一
+        self._compactor = None
+        self._compactor_lock = threading.Lock()
+        self._synced_at = 0.0   # wait_new 最近一次 sync 的时间
+        self.search_index = SearchIndex()
+        self.feed = SmsFeed()
+        self.dedup = DedupCache(DEDUP_TTL, DEDUP_MAX_KEYS)
+        self.code_index = CodeIndex()
+        self.stats_index = SmsStats()
+        self._indexes = [self.search_index, self.feed, self.dedup, self.code_index, self.stats_index]
+
+    def _emit(self, event, records):
+        """把新增（add）/删除（delete）/整体重载（reset）通知派生索引，调用方需持有存储锁"""
+        for index in self._indexes:
+            getattr(index, 'on_' + event)(records)
+
+    @staticmethod
+    def _sender_match(record, sender, exact):
+        value = record.get('sender', '')
+        return value == sender if exact else sender in value
+
+    @classmethod
+    def _export_match(cls, record, ids, sender, exact, start, end_key):
+        if ids is not None and record.get('id') not in ids:
+            return False
+        if sender and not cls._sender_match(record, sender, exact):
+            return False
+        received_at = record.get('received_at', '')
+        if start and received_at < start:
+            return False
+        return not end_key or received_at <= end_key
+
+    def partition(self, device):
+        """设备对应的分区；device 为空时返回整体视图（即自身），设备不存在时返回 None"""
+        return self if not device else self.partitions.get(device)
+
+    def _allocate_ids(self, last_id, count):
+        """为 count 条新记录分配大于 last_id 的递增 id（调用方需持有写锁）"""
+        if self.id_source is not None:
+            return self.id_source.allocate(last_id, count)
+        ids = []
+        for _ in range(count):
+            last_id = next_sms_id(last_id)
+            ids.append(last_id)
+        return ids
+
+    def sync(self):
+        """检查进程外的修改并同步到内存与派生索引，子类实现"""
+
+    def _build_index(self, index):
+        """持有存储锁时用全部记录构建索引，子类实现"""
+        raise NotImplementedError
+
+    def _check_duplicates(self, records, recent):
+        """写锁内的去重检查，返回与 records 一一对应的原记录（不重复为 None）
+
+        recent() 返回最近的记录（按接收顺序），只在首次检查时用于构建去重表。
+        """
+        if not self.dedup.built:
+            self.dedup.rebuild(recent())
+        return self.dedup.check(records)
+
+    def wait_new(self, since_id, timeout, limit=100):
+        """返回 id 大于 since_id 的短信（正序），没有时最多等待 timeout 秒
+
+        只在开始时按游标查一次存储（只取一页）；之后在推送通道上等待写入唤醒，直接从通道取新短信。
+        每秒醒来时 sync 一次（同一进程内的订阅者共用，一秒最多一次），把其他进程写入的短信发布到通道。
+        通道缓冲已溢出、可能漏掉中间的短信时，退回查询存储。
+        """
+        records, _ = self.scan(after_id=since_id, limit=limit)
+        if records:
+            return records
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.feed.closed:
+                return []
+            records, complete = self.feed.wait(since_id, min(1.0, remaining))
+            if records:
+                return records[:limit] if complete else self.scan(after_id=since_id, limit=limit)[0]
+            now = time.monotonic()
+            if now - self._synced_at >= 1.0:
+                self._synced_at = now
+                self.sync()
+
+    def ranked(self, query):
+        """全文检索的全部命中，按 (得分, id) 倒序"""
+        self.sync()
+        if not self.search_index.built:
+            self._build_index(self.search_index)
+        return self.search_index.ranked(query)
+
+    def search(self, query, limit=50, offset=0):
+        """全文检索，返回 (命中总数, 当前页记录)"""
+        scored = self.ranked(query)
+        ids = [sms_id for _, sms_id in scored[max(offset, 0):max(offset, 0) + max(limit, 0)]]
+        return len(scored), [r for r in (self.get(i) for i in ids) if r is not None]
+
+    def latest_code(self, sender=None, brand=None, since=None):
+        """最新一条带验证码的短信（见 CodeIndex.latest）"""
+        self.sync()
+        if not self.code_index.built:
+            self._build_index(self.code_index)
+        return self.code_index.latest(sender, brand, since)
+
+    def stats_snapshots(self):
+        """统计计数表（见 SmsStats.snapshot），每个分区一份"""
+        self.sync()
+        if not self.stats_index.built:
+            self._build_index(self.stats_index)
+        return [self.stats_index.snapshot()]
+
+    def save_stats(self):
+        """把统计计数表写入检查点"""
+        self.stats_index.save()
+
+    def compact(self):
+        """后台维护（合并、裁剪），子类实现"""
+        return False
+
+    def _expired(self):
+        """按时间 / 大小保留策略找出应移出在线库的记录（按接收顺序）"""
+        expired = {}
+        if self.max_age_days:
+            cutoff = (datetime.now(CHINA_TZ) - timedelta(days=self.max_age_days)).strftime('%Y-%m-%d %H:%M:%S')
+            for record in self.iter_records(end=cutoff):
+                if record.get('received_at', '') < cutoff:
+                    expired[record.get('id')] = record
+        if self.max_bytes:
+            sizes = array('q', (len(json.dumps(r, ensure_ascii=False).encode('utf-8')) for r in self.iter_records()))
+            total, drop = sum(sizes), 0
+            while total > self.max_bytes and drop < len(sizes):
+                total -= sizes[drop]
+                drop += 1
+            for record in islice(self.iter_records(), drop):
+                expired[record.get('id')] = record
+        return sorted(expired.values(), key=lambda r: r.get('id', 0))
+
+    def retain(self):
+        """执行按时间 / 大小的保留策略：过期记录先写入归档再从在线库删除，返回移出条数
+
+        按条数的限制由 compact 执行（裁掉的记录同样写入归档）。
+        多进程部署时同一时刻只有一个进程执行，避免重复归档。
+        """
+        if not (self.max_age_days or self.max_bytes):
+            return 0
+        with (self.archive.exclusive() if self.archive is not None else nullcontext(True)) as acquired:
+            if not acquired:
+                return 0
+            expired = self._expired()
+            if not expired:
+                return 0
+            if self.archive is not None:
+                self.archive.append(expired)
+            self.delete([r.get('id') for r in expired])
+        logger.info(f"保留策略：{len(expired)} 条短信移出在线库")
+        return len(expired)
+
+    def start_compactor(self):
+        """启动后台维护线程（只启动一次）"""
+        with self._compactor_lock:
+            if self._compactor is not None:
+                return
+            self._compactor = threading.Thread(target=self._compact_loop, name='store-compactor', daemon=True)
+            self._compactor.start()
+
+    def _compact_loop(self):
+        while True:
+            time.sleep(self.compact_interval)
+            try:
+                self.retain()
+                self.compact()
+                self.save_stats()
+            except Exception as e:
+                logger.error(f"存储维护失败: {e}")
+
+
+class LogStore(BaseStore):
+    """短信存储：JSON 快照 + 追加写日志（WAL）
+
+    新短信以一行 JSON 追加到 WAL 并 fsync，写入成本与已存条数无关；删除同样只在 WAL 中记一条墓碑（del）；
+    后台线程定期把 WAL 合并进快照（写临时文件后原子替换），并执行 MAX_LOG_ENTRIES 限制。
+    解析后的记录常驻内存（有序列表 + 按 id 索引），由写路径直接更新；
+    读取前比对快照的 mtime/size 和 WAL 长度，发现进程外的修改时才重新加载或只读取新增部分。
+    并发：进程内用线程锁，进程间用 fcntl 文件锁（读共享、写独占），多 worker 部署也不会丢消息。
+    """
+
+    backend = 'json'    # 指标中的 backend 标签
+
+    def __init__(self, snapshot_file, wal_file, max_entries, compact_interval=COMPACT_INTERVAL):
+        super().__init__()
+        self.snapshot_file = snapshot_file
+        self.wal_file = wal_file
+        self.max_entries = max_entries
+        self.compact_interval = compact_interval
+        self.lock_file = snapshot_file + '.lock'
+        self._lock = threading.Lock()
+        self._lock_fd = None
+        self._lock_pid = None
+        self._records = []      # 按接收顺序排列的记录
+        self._ids = array('q')  # 与 _records 对应的 id，单调递增，用于游标翻页二分查找
+        self._by_id = {}        # id -> 记录
+        self._snapshot_sig = None
+        self._wal_offset = 0    # 已读入缓存的 WAL 字节数
+        self._loaded = False
+
+    @staticmethod
+    def _file_sig(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    @contextmanager
+    def _locked(self, shared=False):
+        """线程锁 + 进程间文件锁"""
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            if self._lock_pid != os.getpid():
+                # fork 出的子进程需要自己的文件描述符，否则会与父进程共用同一把锁
+                self._lock_fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+                self._lock_pid = os.getpid()
+            fcntl.flock(self._lock_fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _read_snapshot(self):
+        if os.path.exists(self.snapshot_file):
+            try:
+                with open(self.snapshot_file, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except (json.JSONDecodeError, IOError):
+                return []
+        return []
+
+    def _reset_cache(self, logs):
+        self._records = logs
+        self._ids = array('q', (l.get('id', 0) for l in logs))
+        self._by_id = {l.get('id'): l for l in logs}
+        self._emit('reset', logs)
+
+    def _apply_add(self, records):
+        for record in records:
+            self._records.append(record)
+            self._ids.append(record.get('id', 0))
+            self._by_id[record.get('id')] = record
+        self._emit('add', records)
+
+    def _apply_delete(self, ids):
+        """从缓存中移除指定 id 的记录（生成新列表，不影响正在遍历旧列表的导出），返回被删除的记录"""
+        removed = [self._by_id.pop(i) for i in ids if i in self._by_id]
+        if removed:
+            gone = {r.get('id') for r in removed}
+            self._records = [l for l in self._records if l.get('id') not in gone]
+            self._ids = array('q', (l.get('id', 0) for l in self._records))
+            self._emit('delete', removed)
+        return removed
+
+    def _replay_wal(self, offset):
+        """从 offset 开始把 WAL 中的新增与墓碑按顺序应用到缓存（跳过已在快照中的记录和写了一半的行）"""
+        try:
+            f = open(self.wal_file, 'rb')
+        except FileNotFoundError:
+            self._wal_offset = 0
+            return
+        with f:
+            f.seek(offset)
+            added = []
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # 未写完的最后一行，等写完后再读
+                offset += len(line)
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # 崩溃时留下的残行
+                record = entry.get('record')
+                if entry.get('op') == 'add' and record and not self._in_snapshot(record):
+                    added.append(record)
+                elif entry.get('op') == 'del':
+                    self._apply_add(added)
+                    added = []
+                    self._apply_delete(entry.get('ids') or [])
+        self._apply_add(added)
+        self._wal_offset = offset
+
+    def _refresh(self):
+        """使缓存与磁盘一致（需持有锁）"""
+        snapshot_sig = self._file_sig(self.snapshot_file)
+        wal_sig = self._file_sig(self.wal_file)
+        wal_size = wal_sig[2] if wal_sig else 0  # (ino, mtime_ns, size)
+        if not self._loaded or snapshot_sig != self._snapshot_sig or wal_size < self._wal_offset:
+            metrics.inc('sms_store_cache_total', result='miss')
+            with metrics.timer('sms_store_load_seconds', backend=self.backend):
+                self._reset_cache(self._read_snapshot())
+                self._snapshot_sig = snapshot_sig
+                self._loaded = True
+                self._replay_wal(0)
+        elif wal_size > self._wal_offset:
+            metrics.inc('sms_store_cache_total', result='tail')
+            self._replay_wal(self._wal_offset)
+        else:
+            metrics.inc('sms_store_cache_total', result='hit')
+
+    def _append_wal(self, entries, op):
+        """把 entries 追加写入 WAL 并 fsync（需持有写锁）"""
+        data = b''.join((json.dumps(e, ensure_ascii=False) + '\n').encode('utf-8') for e in entries)
+        with metrics.timer('sms_store_save_seconds', backend=self.backend, op=op):
+            with open(self.wal_file, 'ab') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        metrics.inc('sms_store_bytes_written_total', len(data), backend=self.backend)
+        self._wal_offset += len(data)
+
+    def _fsync_dir(self):
+        """fsync 快照所在目录，使 os.replace 的结果落盘"""
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.snapshot_file)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def _write_snapshot(self, logs, removed=None):
+        """原子写入快照并清空 WAL（需持有写锁且缓存已刷新）
+
+        removed 为 None 表示整体替换（索引重建），否则只把 removed 与超限裁掉的记录通知为删除。
+        """
+        trimmed = []
+        if len(logs) > self.max_entries:
+            trimmed = logs[:-self.max_entries]
+            logs = logs[-self.max_entries:]
+            if self.archive is not None:
+                self.archive.append(trimmed)
+        if self._wal_offset:
+            # 新快照不再包含的记录（裁掉、清空或被替换）先在 WAL 中记墓碑：
+            # 若在替换快照之后、清空 WAL 之前崩溃，重放时它们不会被 WAL 中的 add 带回来
+            kept = {l.get('id') for l in logs}
+            gone = [i for i in self._by_id if i not in kept]
+            if gone:
+                self._append_wal([{"op": "del", "ids": gone}], 'snapshot')
+        tmp_file = f"{self.snapshot_file}.{os.getpid()}.tmp"
+        with metrics.timer('sms_store_save_seconds', backend=self.backend, op='snapshot'):
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(logs, f, ensure_ascii=False, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+                metrics.inc('sms_store_bytes_written_total', f.tell(), backend=self.backend)
+            os.replace(tmp_file, self.snapshot_file)
+            self._fsync_dir()
+        # 快照已包含 WAL 中应保留的全部记录；若在此之前崩溃，重放时会跳过快照中已有的记录，
+        # 并按墓碑删除不再保留的记录
+        with open(self.wal_file, 'w', encoding='utf-8'):
+            pass
+        self._records = list(logs)
+        self._ids = array('q', (l.get('id', 0) for l in self._records))
+        self._by_id = {l.get('id'): l for l in self._records}
+        self._snapshot_sig = self._file_sig(self.snapshot_file)
+        self._wal_offset = 0
+        self._loaded = True
+        if removed is None:
+            self._emit('reset', self._records)
+        elif removed or trimmed:
+            self._emit('delete', list(removed) + trimmed)
+
+    def sync(self):
+        with self._locked(shared=True):
+            self._refresh()
+
+    def _build_index(self, index):
+        with self._locked(shared=True):
+            self._refresh()
+            index.rebuild(self._records)
+
+    def _lookup(self, sms_id):
+        """缓存中 id 对应的记录（需持有锁）"""
+        return self._by_id.get(sms_id)
+
+    def _in_snapshot(self, record):
+        """重放 WAL 时判断记录是否已在快照中"""
+        return self._by_id.get(record.get('id')) == record
+
+    def _has(self, sms_id):
+        return sms_id in self._by_id
+
+    def _sender_positions(self, positions, sender, exact):
+        """依次产出 positions 中发送者匹配的下标（需持有锁）"""
+        records = self._records
+        return (i for i in positions if self._sender_match(records[i], sender, exact))
+
+    def _export_match_at(self, records, i, ids, sender, exact, start, end_key):
+        """records 中第 i 条记录是否符合导出 / 删除条件"""
+        return self._export_match(records[i], ids, sender, exact, start, end_key)
+
+    def load(self):
+        """读取全部记录（按接收顺序，返回副本）"""
+        with self._locked(shared=True):
+            self._refresh()
+            return list(self._records)
+
+    def count(self):
+        """记录条数"""
+        with self._locked(shared=True):
+            self._refresh()
+            return len(self._records)
+
+    def get(self, sms_id):
+        """按 id 取单条记录，不存在时返回 None"""
+        with self._locked(shared=True):
+            self._refresh()
+            return self._lookup(sms_id)
+
+    @staticmethod
+    def _page(records, limit, offset):
+        """从按时间正序的列表中取倒序的一页，不复制整个列表"""
+        end = max(len(records) - max(offset, 0), 0)
+        start = max(end - max(limit, 0), 0)
+        return records[start:end][::-1]
+
+    def recent(self, limit, offset=0):
+        """按时间倒序取一页记录"""
+        with self._locked(shared=True):
+            self._refresh()
+            return self._page(self._records, limit, offset)
+
+    def query(self, sender=None, exact=False, limit=50, offset=0):
+        """按发送者过滤并分页（倒序），返回 (总数, 当前页)"""
+        with self._locked(shared=True):
+            self._refresh()
+            if not sender:
+                return len(self._records), self._page(self._records, limit, offset)
+            positions = list(self._sender_positions(range(len(self._records)), sender, exact))
+            return len(positions), [self._records[i] for i in self._page(positions, limit, offset)]
+
+    def scan(self, before_id=None, after_id=None, limit=50, sender=None, exact=False):
+        """按 id 游标翻页：after_id 向新翻（正序），否则从 before_id（缺省为最新）向旧翻（倒序）
+
+        二分定位起点后只遍历到凑满一页为止，返回 (记录列表, 是否还有更多)。
+        """
+        with self._locked(shared=True):
+            self._refresh()
+            if after_id is not None:
+                positions = range(bisect_right(self._ids, after_id), len(self._records))
+            else:
+                end = bisect_left(self._ids, before_id) if before_id is not None else len(self._records)
+                positions = range(end - 1, -1, -1)
+            if sender:
+                positions = self._sender_positions(positions, sender, exact)
+            page = []
+            for i in positions:
+                if len(page) >= limit:
+                    return page, True
+                page.append(self._records[i])
+            return page, False
+
+    def iter_records(self, ids=None, sender=None, exact=False, start=None, end=None):
+        """按接收顺序逐条产出符合条件的记录（导出用）
+
+        start / end 与 received_at 按字符串比较，end 可以只写日期（包含当天）。
+        只在开始时持锁取得当前列表的引用，之后的写入会换成新列表或追加在末尾，不影响本次遍历。
+        """
+        with self._locked(shared=True):
+            self._refresh()
+            records, count = self._records, len(self._records)
+        ids = set(ids) if ids else None
+        end_key = end + '\uffff' if end else None
+        for i in range(count):
+            if self._export_match_at(records, i, ids, sender, exact, start, end_key):
+                yield records[i]
+
+    def append(self, record):
+        """追加一条记录，返回时已落盘"""
+        self.extend([record])
+
+    def extend(self, records, dedup=False):
+        """追加多条记录，只写一次、fsync 一次；id 为 None 的记录在锁内分配 id
+
+        dedup 为 True 时在锁内跳过重复推送（包括同一批内的重复），重复记录的 id 设为原记录的 id。
+        返回与 records 一一对应的是否重复。
+        """
+        with self._locked():
+            self._refresh()
+            originals = [None] * len(records)
+            if dedup:
+                originals = self._check_duplicates(records, lambda: self._records[-self.dedup.max_keys:])
+            fresh = [r for r, original in zip(records, originals) if original is None]
+            pending = [r for r in fresh if r.get('id') is None]
+            for record, sms_id in zip(pending, self._allocate_ids(self._ids[-1] if self._ids else 0, len(pending))):
+                record['id'] = sms_id
+            if fresh:
+                self._append_wal(({"op": "add", "record": r} for r in fresh), 'append')
+                self._apply_add(fresh)
+        for record, original in zip(records, originals):
+            if original is not None:
+                record['id'] = original['id']
+        self.start_compactor()
+        return [original is not None for original in originals]
+
+    def replace(self, logs):
+        """用 logs 整体替换存储内容"""
+        with self._locked():
+            self._refresh()
+            self._write_snapshot(logs)
+
+    def delete(self, ids=None, sender=None, exact=False, start=None, end=None):
+        """删除符合条件的记录（条件同 iter_records，同时给出时取交集），返回删除条数
+
+        只按 id 删除时经 id 索引定位，否则扫描一遍内存列表；删除本身只向 WAL 追加一条墓碑，
+        快照由后台合并时重写，耗时与选中条数无关。
+        """
+        with self._locked():
+            self._refresh()
+            if ids is not None and not (sender or start or end):
+                targets = [i for i in set(ids) if self._has(i)]
+            else:
+                ids = set(ids) if ids is not None else None
+                end_key = end + '\uffff' if end else None
+                targets = [self._ids[i] for i in range(len(self._records))
+                           if self._export_match_at(self._records, i, ids, sender, exact, start, end_key)]
+            if not targets:
+                return 0
+            self._append_wal([{"op": "del", "ids": targets}], 'delete')
+            removed = self._apply_delete(targets)
+        self.start_compactor()
+        return len(removed)
+
+    def clear(self):
+        """清空全部记录"""
+        with self._locked():
+            self._refresh()
+            self._write_snapshot([])
+
+    def compact(self):
+        """把 WAL 合并进快照，WAL 为空时不做任何事"""
+        with self._locked():
+            if not os.path.exists(self.wal_file) or os.path.getsize(self.wal_file) == 0:
+                return False
+            self._refresh()
+            self._write_snapshot(self._records, removed=[])
+            return True
+
+
+
+class PackedRecords:
+    """PackedLogStore 缓存中的记录序列：快照部分只保存各记录在 mmap 中的偏移量，按下标取出时才解码成 dict；
+    WAL 中新增、尚未合并的记录以 dict 放在 tail
+
+    删除时生成新的序列对象，新增只追加到 tail 末尾，正在遍历旧序列的导出不受影响。
+    """
+
+    __slots__ = ('buf', 'offsets', 'tail')
+
+    HEADER = struct.Struct('<IqII')     # 记录总字节数、id、sender 字节数、received_at 字节数
+    INLINE = ('id', 'sender', 'received_at')
+
+    def __init__(self, buf, offsets, tail):
+        self.buf = buf
+        self.offsets = offsets
+        self.tail = tail
+
+    @classmethod
+    def encode(cls, record):
+        """记录编码：定长头 + sender + received_at（原始 UTF-8，过滤时不必解码）+ 其余字段的紧凑 JSON"""
+        sender = (record.get('sender') or '').encode('utf-8')
+        received_at = (record.get('received_at') or '').encode('utf-8')
+        rest = json.dumps({k: v for k, v in record.items() if k not in cls.INLINE},
+                          ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        size = cls.HEADER.size + len(sender) + len(received_at) + len(rest)
+        return cls.HEADER.pack(size, record.get('id', 0), len(sender), len(received_at)) + sender + received_at + rest
+
+    def _decode(self, offset):
+        size, sms_id, sender_len, received_len = self.HEADER.unpack_from(self.buf, offset)
+        start = offset + self.HEADER.size
+        record = {'id': sms_id, 'sender': self.buf[start:start + sender_len].decode('utf-8')}
+        start += sender_len
+        received_at = self.buf[start:start + received_len].decode('utf-8')
+        record.update(json.loads(self.buf[start + received_len:offset + size]))
+        record['received_at'] = received_at
+        return record
+
+    def __len__(self):
+        return len(self.offsets) + len(self.tail)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if 0 <= i < len(self.offsets):
+            return self._decode(self.offsets[i])
+        return self.tail[i - len(self.offsets)]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def id_at(self, i):
+        if i < len(self.offsets):
+            return self.HEADER.unpack_from(self.buf, self.offsets[i])[1]
+        return self.tail[i - len(self.offsets)].get('id', 0)
+
+    def sender_at(self, i):
+        """第 i 条记录的发送者（UTF-8 字节）"""
+        if i < len(self.offsets):
+            offset = self.offsets[i]
+            sender_len = self.HEADER.unpack_from(self.buf, offset)[2]
+            return self.buf[offset + self.HEADER.size:offset + self.HEADER.size + sender_len]
+        return (self.tail[i - len(self.offsets)].get('sender') or '').encode('utf-8')
+
+    def received_at(self, i):
+        if i < len(self.offsets):
+            offset = self.offsets[i]
+            _, _, sender_len, received_len = self.HEADER.unpack_from(self.buf, offset)
+            start = offset + self.HEADER.size + sender_len
+            return self.buf[start:start + received_len].decode('utf-8')
+        return self.tail[i - len(self.offsets)].get('received_at', '')
+
+    def raw(self, i):
+        """第 i 条记录的编码字节：快照中的记录直接切片，不经过解码"""
+        if i < len(self.offsets):
+            offset = self.offsets[i]
+            return self.buf[offset:offset + self.HEADER.unpack_from(self.buf, offset)[0]]
+        return self.encode(self.tail[i - len(self.offsets)])
+
+
+class PackedLogStore(LogStore):
+    """紧凑二进制快照 + WAL（STORAGE_BACKEND = "packed"），适合在线库保留大量历史记录的部署
+
+    快照由长度前缀的记录和文件末尾的 id / 偏移量索引组成，加载时 mmap 整个文件，只把索引读成两个
+    array('q')，每条记录常驻内存 16 字节；短信内容在取出一页、导出或重建派生索引时才逐条解码，
+    按发送者、时间过滤直接比较 mmap 中的原始字节。合并 WAL 时快照中已有的记录按原始字节复制。
+    WAL、文件锁、墓碑与崩溃恢复流程与 LogStore 相同。
+
+    文件格式：MAGIC | 记录 ... | id 列（int64 × n）| 偏移量列（int64 × n）| n、索引起点（uint64 × 2）| MAGIC，
+    均为小端序。
+    """
+
+    backend = 'packed'
+    MAGIC = b'SMSPACK1'
+    FOOTER = struct.Struct('<QQ8s')     # 记录数、索引起点、MAGIC
+
+    def __init__(self, snapshot_file, wal_file, max_entries, compact_interval=COMPACT_INTERVAL):
+        super().__init__(snapshot_file, wal_file, max_entries, compact_interval)
+        self._records = PackedRecords(b'', array('q'), [])
+
+    @staticmethod
+    def _column_bytes(column):
+        if sys.byteorder == 'big':
+            column = array('q', column)
+            column.byteswap()
+        return column.tobytes()
+
+    def _read_snapshot(self):
+        """映射快照文件，返回 (缓冲区, id 列, 偏移量列)；文件不存在或格式不对时返回 None"""
+        try:
+            f = open(self.snapshot_file, 'rb')
+        except FileNotFoundError:
+            return None
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size < len(self.MAGIC) + self.FOOTER.size:
+                return None
+            if os.name == 'nt':
+                buf = f.read()  # Windows 上仍被映射的文件不能被 os.replace 覆盖
+            else:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        count, index_at, magic = self.FOOTER.unpack_from(buf, size - self.FOOTER.size)
+        if buf[:len(self.MAGIC)] != self.MAGIC or magic != self.MAGIC \
+                or index_at + 16 * count + self.FOOTER.size != size:
+            logger.error(f"快照文件格式不正确，按空库处理: {self.snapshot_file}")
+            return None
+        ids, offsets = array('q'), array('q')
+        ids.frombytes(buf[index_at:index_at + 8 * count])
+        offsets.frombytes(buf[index_at + 8 * count:index_at + 16 * count])
+        if sys.byteorder == 'big':
+            ids.byteswap()
+            offsets.byteswap()
+        return buf, ids, offsets
+
+    def _reset_cache(self, snapshot):
+        buf, self._ids, offsets = snapshot or (b'', array('q'), array('q'))
+        self._records = PackedRecords(buf, offsets, [])
+        self._emit('reset', self._records)
+
+    def _apply_add(self, records):
+        for record in records:
+            self._records.tail.append(record)
+            self._ids.append(record.get('id', 0))
+        self._emit('add', records)
+
+    def _position(self, sms_id):
+        """id 在缓存中的下标（id 单调递增，二分查找），不存在时返回 None"""
+        i = bisect_left(self._ids, sms_id) if isinstance(sms_id, int) else len(self._ids)
+        return i if i < len(self._ids) and self._ids[i] == sms_id else None
+
+    def _lookup(self, sms_id):
+        i = self._position(sms_id)
+        return None if i is None else self._records[i]
+
+    def _has(self, sms_id):
+        return self._position(sms_id) is not None
+
+    def _in_snapshot(self, record):
+        return self._has(record.get('id'))   # 解码后的字段可能被规整过（如缺省的 sender），只比较 id
+
+    def _sender_positions(self, positions, sender, exact):
+        view, needle = self._records, sender.encode('utf-8')
+        buf, offsets, snapshot_count = view.buf, view.offsets, len(view.offsets)
+        unpack, header_size = view.HEADER.unpack_from, view.HEADER.size
+        for i in positions:
+            if i < snapshot_count:
+                start = offsets[i] + header_size
+                value = buf[start:start + unpack(buf, offsets[i])[2]]
+            else:
+                value = view.sender_at(i)
+            if value == needle if exact else needle in value:
+                yield i
+
+    def _export_match_at(self, records, i, ids, sender, exact, start, end_key):
+        if ids is not None and records.id_at(i) not in ids:
+            return False
+        if sender:
+            value = records.sender_at(i)
+            if not (value == sender.encode('utf-8') if exact else sender.encode('utf-8') in value):
+                return False
+        if start or end_key:
+            received_at = records.received_at(i)
+            if (start and received_at < start) or (end_key and received_at > end_key):
+                return False
+        return True
+
+    def _apply_delete(self, ids):
+        drop = {i for i in map(self._position, ids) if i is not None}
+        if not drop:
+            return []
+        view = self._records
+        removed = [view[i] for i in sorted(drop)]
+        snapshot_count = len(view.offsets)
+        offsets = array('q', (o for i, o in enumerate(view.offsets) if i not in drop))
+        tail = [r for i, r in enumerate(view.tail, snapshot_count) if i not in drop]
+        self._ids = array('q', (x for i, x in enumerate(self._ids) if i not in drop))
+        self._records = PackedRecords(view.buf, offsets, tail)
+        self._emit('delete', removed)
+        return removed
+
+    def _write_snapshot(self, logs, removed=None):
+        """原子写入快照并清空 WAL（需持有写锁且缓存已刷新），流程同 LogStore._write_snapshot
+
+        logs 为当前缓存（合并）时快照中已有的记录按原始字节复制，不解码；max_entries 为 0 表示不限条数。
+        """
+        if not isinstance(logs, PackedRecords):
+            logs = PackedRecords(b'', array('q'), list(logs))
+        first = max(len(logs) - self.max_entries, 0) if self.max_entries else 0
+        trimmed = logs[:first]
+        if trimmed and self.archive is not None:
+            self.archive.append(trimmed)
+        if self._wal_offset:
+            kept = {logs.id_at(i) for i in range(first, len(logs))}
+            gone = [i for i in self._ids if i not in kept]
+            if gone:
+                self._append_wal([{"op": "del", "ids": gone}], 'snapshot')
+        tmp_file = f"{self.snapshot_file}.{os.getpid()}.tmp"
+        ids, offsets = array('q'), array('q')
+        with metrics.timer('sms_store_save_seconds', backend=self.backend, op='snapshot'):
+            with open(tmp_file, 'wb') as f:
+                f.write(self.MAGIC)
+                for i in range(first, len(logs)):
+                    ids.append(logs.id_at(i))
+                    offsets.append(f.tell())
+                    f.write(logs.raw(i))
+                index_at = f.tell()
+                f.write(self._column_bytes(ids))
+                f.write(self._column_bytes(offsets))
+                f.write(self.FOOTER.pack(len(ids), index_at, self.MAGIC))
+                f.flush()
+                os.fsync(f.fileno())
+                metrics.inc('sms_store_bytes_written_total', f.tell(), backend=self.backend)
+            os.replace(tmp_file, self.snapshot_file)
+            self._fsync_dir()
+        with open(self.wal_file, 'w', encoding='utf-8'):
+            pass
+        buf, self._ids, offsets = self._read_snapshot() or (b'', array('q'), array('q'))
+        self._records = PackedRecords(buf, offsets, [])
+        self._snapshot_sig = self._file_sig(self.snapshot_file)
+        self._wal_offset = 0
+        self._loaded = True
+        if removed is None:
+            self._emit('reset', self._records)
+        elif removed or trimmed:
+            self._emit('delete', list(removed) + trimmed)
+
+
+class SqliteLogStore(BaseStore):
+    """SQLite 存储（WAL 模式）
+
+    id / sender / received_at 建有索引，分页与按发送者查询走索引而不是全量扫描；
+    连接放在一个小连接池里按需借还，PRAGMA 只在建立连接时设置一次，参数化语句由 sqlite3 模块缓存复用。
+    记录中表结构以外的字段以 JSON 存在 extra 列。
+    其他进程的写入通过 PRAGMA data_version 发现：只有新增时增量同步到派生索引，否则重建。
+    """
+
+    COLUMNS = ('id', 'sender', 'message', 'pdu_timestamp', 'received_at', 'client_ip')
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS sms (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id INTEGER NOT NULL,
+            sender TEXT NOT NULL DEFAULT '',
+            message TEXT NOT NULL DEFAULT '',
+            pdu_timestamp TEXT NOT NULL DEFAULT '',
+            received_at TEXT NOT NULL DEFAULT '',
+            client_ip TEXT,
+            extra TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_sms_id ON sms(id);
+        CREATE INDEX IF NOT EXISTS idx_sms_sender ON sms(sender, seq);
+        CREATE INDEX IF NOT EXISTS idx_sms_received_at ON sms(received_at);
+    '''
+    SELECT = 'SELECT id, sender, message, pdu_timestamp, received_at, client_ip, extra FROM sms'
+    POOL_SIZE = 8   # 连接池保留的空闲连接数，并发超出时临时建立、用完即关
+
+    def __init__(self, db_file, max_entries, compact_interval=COMPACT_INTERVAL):
+        super().__init__()
+        self.db_file = db_file
+        self.max_entries = max_entries
+        self.compact_interval = compact_interval
+        self._pool = []
+        self._pool_pid = os.getpid()
+        self._pool_lock = threading.Lock()
+        self._lock = threading.Lock()   # 保证写入与索引通知的顺序
+        self._watch_conn = None
+        self._watch_pid = None
+        self._data_version = None
+        with self._conn() as conn:
+            conn.executescript(self.SCHEMA)
+            self._known = self._state(conn)
+
+    @staticmethod
+    def _state(conn):
+        """(最大 seq, 记录数)，用于判断其他进程做了什么修改"""
+        max_seq, count = conn.execute('SELECT COALESCE(MAX(seq), 0), COUNT(*) FROM sms').fetchone()
+        return max_seq, count
+
+    @contextmanager
+    def _conn(self):
+        """从连接池借一个连接，用完归还（fork 后丢弃父进程的连接重新建立）"""
+        with self._pool_lock:
+            if self._pool_pid != os.getpid():
+                self._pool, self._pool_pid = [], os.getpid()
+            conn = self._pool.pop() if self._pool else None
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=FULL')
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            with self._pool_lock:
+                if self._pool_pid == os.getpid() and len(self._pool) < self.POOL_SIZE:
+                    self._pool.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        with self._conn() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    @classmethod
+    def _to_row(cls, record):
+        extra = {k: v for k, v in record.items() if k not in cls.COLUMNS}
+        return (
+            record.get('id'),
+            record.get('sender') or '',
+            record.get('message') or '',
+            record.get('pdu_timestamp') or '',
+            record.get('received_at') or '',
+            record.get('client_ip'),
+            json.dumps(extra, ensure_ascii=False) if extra else None,
+        )
+
+    @classmethod
+    def _to_record(cls, row):
+        record = dict(zip(cls.COLUMNS, row))
+        if row[6]:
+            record.update(json.loads(row[6]))
+        return record
+
+    def _insert(self, conn, records):
+        conn.executemany(
+            'INSERT INTO sms (id, sender, message, pdu_timestamp, received_at, client_ip, extra) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [self._to_row(r) for r in records])
+
+    def sync(self):
+        with self._lock:
+            if self._watch_pid != os.getpid():
+                self._watch_conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None,
+                                                   check_same_thread=False)
+                self._watch_pid = os.getpid()
+            version = self._watch_conn.execute('PRAGMA data_version').fetchone()[0]
+            if version == self._data_version:
+                return
+            self._data_version = version
+            self._catch_up(self._watch_conn)
+
+    def _catch_up(self, conn):
+        """把其他进程的修改同步到派生索引（需持有 self._lock；在写事务内调用时结果是准确的）"""
+        max_seq, count = self._state(conn)
+        known_seq, known_count = self._known
+        if (max_seq, count) == self._known:
+            return
+        rows = conn.execute(self.SELECT + ' WHERE seq > ? ORDER BY seq', (known_seq,)).fetchall()
+        if known_count + len(rows) == count:
+            self._emit('add', [self._to_record(r) for r in rows])
+        else:
+            self._emit('reset', [self._to_record(r) for r in conn.execute(self.SELECT + ' ORDER BY seq')])
+        self._known = (max_seq, count)
+
+    def _build_index(self, index):
+        with self._lock:
+            index.rebuild(self.load())
+
+    def load(self):
+        """读取全部记录（按接收顺序）"""
+        with metrics.timer('sms_store_load_seconds', backend='sqlite'):
+            with self._conn() as conn:
+                return [self._to_record(r) for r in conn.execute(self.SELECT + ' ORDER BY seq')]
+
+    def count(self):
+        """记录条数"""
+        with self._conn() as conn:
+            return conn.execute('SELECT COUNT(*) FROM sms').fetchone()[0]
+
+    def get(self, sms_id):
+        """按 id 取单条记录，不存在时返回 None"""
+        with self._conn() as conn:
+            row = conn.execute(self.SELECT + ' WHERE id = ? ORDER BY seq DESC LIMIT 1', (sms_id,)).fetchone()
+        return self._to_record(row) if row else None
+
+    def recent(self, limit, offset=0):
+        """按时间倒序取一页记录"""
+        with self._conn() as conn:
+            rows = conn.execute(self.SELECT + ' ORDER BY seq DESC LIMIT ? OFFSET ?',
+                                (max(limit, 0), max(offset, 0)))
+            return [self._to_record(r) for r in rows]
+
+    def query(self, sender=None, exact=False, limit=50, offset=0):
+        """按发送者过滤并分页（倒序），返回 (总数, 当前页)"""
+        if not sender:
+            return self.count(), self.recent(limit, offset)
+        where = ' WHERE sender = ?' if exact else ' WHERE instr(sender, ?) > 0'
+        with self._conn() as conn:
+            total = conn.execute('SELECT COUNT(*) FROM sms' + where, (sender,)).fetchone()[0]
+            rows = conn.execute(self.SELECT + where + ' ORDER BY seq DESC LIMIT ? OFFSET ?',
+                                (sender, max(limit, 0), max(offset, 0)))
+            return total, [self._to_record(r) for r in rows]
+
+    def scan(self, before_id=None, after_id=None, limit=50, sender=None, exact=False):
+        """按 id 游标翻页（走 id 索引），返回 (记录列表, 是否还有更多)"""
+        clauses, params = [], []
+        if after_id is not None:
+            clauses.append('id > ?')
+            params.append(after_id)
+            order = 'ASC'
+        else:
+            if before_id is not None:
+                clauses.append('id < ?')
+                params.append(before_id)
+            order = 'DESC'
+        if sender:
+            clauses.append('sender = ?' if exact else 'instr(sender, ?) > 0')
+            params.append(sender)
+        where = (' WHERE ' + ' AND '.join(clauses)) if clauses else ''
+        with self._conn() as conn:
+            rows = conn.execute(self.SELECT + where + f' ORDER BY id {order} LIMIT ?',
+                                params + [max(limit, 0) + 1]).fetchall()
+        page = [self._to_record(r) for r in rows[:max(limit, 0)]]
+        return page, len(rows) > len(page)
+
+    @staticmethod
+    def _filters(sender, exact, start, end):
+        """发送者 / 时间范围条件，返回 (WHERE 子句列表, 参数列表)"""
+        clauses, params = [], []
+        if sender:
+            clauses.append('sender = ?' if exact else 'instr(sender, ?) > 0')
+            params.append(sender)
+        if start:
+            clauses.append('received_at >= ?')
+            params.append(start)
+        if end:
+            clauses.append('received_at <= ?')
+            params.append(end + '\uffff')
+        return clauses, params
+
+    def iter_records(self, ids=None, sender=None, exact=False, start=None, end=None):
+        """按接收顺序逐条产出符合条件的记录（导出用），由游标流式读取；读完或生成器关闭时归还连接"""
+        clauses, params = self._filters(sender, exact, start, end)
+        with self._conn() as conn:
+            if not ids:
+                where = (' WHERE ' + ' AND '.join(clauses)) if clauses else ''
+                for row in conn.execute(self.SELECT + where + ' ORDER BY seq', params):
+                    yield self._to_record(row)
+                return
+            ids = sorted(set(ids))
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                where = ' WHERE ' + ' AND '.join(clauses + [f'id IN ({",".join("?" * len(chunk))})'])
+                for row in conn.execute(self.SELECT + where + ' ORDER BY id, seq', params + chunk):
+                    yield self._to_record(row)
+
+    def append(self, record):
+        """追加一条记录，返回时已提交"""
+        self.extend([record])
+
+    def extend(self, records, dedup=False):
+        """在一个事务中追加多条记录；id 为 None 的记录在事务内分配 id
+
+        dedup 为 True 时在事务内跳过重复推送（同 LogStore.extend），返回与 records 一一对应的是否重复。
+        """
+        with self._lock:
+            with self._transaction() as conn:
+                # 先把其他进程已提交的写入同步进来，_known 才能准确推进到本次写入之后，去重表也是最新的
+                self._catch_up(conn)
+                originals = [None] * len(records)
+                if dedup:
+                    originals = self._check_duplicates(records, lambda: [
+                        self._to_record(r) for r in conn.execute(self.SELECT + ' ORDER BY seq DESC LIMIT ?',
+                                                                 (self.dedup.max_keys,))][::-1])
+                fresh = [r for r, original in zip(records, originals) if original is None]
+                pending = [r for r in fresh if r.get('id') is None]
+                last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM sms').fetchone()[0]
+                for record, sms_id in zip(pending, self._allocate_ids(last_id, len(pending))):
+                    record['id'] = sms_id
+                if fresh:
+                    with metrics.timer('sms_store_save_seconds', backend='sqlite', op='append'):
+                        self._insert(conn, fresh)
+                    self._known = self._state(conn)
+            if fresh:
+                self._emit('add', fresh)
+        for record, original in zip(records, originals):
+            if original is not None:
+                record['id'] = original['id']
+        self.start_compactor()
+        return [original is not None for original in originals]
+
+    def replace(self, logs):
+        """用 logs 整体替换存储内容，超出 max_entries 的旧记录写入归档（同 compact）"""
+        trimmed = []
+        if self.max_entries and len(logs) > self.max_entries:
+            trimmed, logs = logs[:-self.max_entries], logs[-self.max_entries:]
+        with self._lock:
+            with self._transaction() as conn:
+                if trimmed and self.archive is not None:
+                    self.archive.append(trimmed)
+                conn.execute('DELETE FROM sms')
+                self._insert(conn, logs)
+                self._known = self._state(conn)
+            self._emit('reset', logs)
+
+    def delete(self, ids=None, sender=None, exact=False, start=None, end=None):
+        """删除符合条件的记录（条件同 iter_records，同时给出时取交集），返回删除条数
+
+        按 id 删除时分批走 id 索引，按发送者 / 时间范围删除时一条语句完成。
+        """
+        clauses, params = self._filters(sender, exact, start, end)
+        removed = []
+        with self._lock:
+            with self._transaction() as conn:
+                self._catch_up(conn)
+                if ids is None:
+                    where = (' WHERE ' + ' AND '.join(clauses)) if clauses else ''
+                    removed.extend(self._to_record(r) for r in conn.execute(self.SELECT + where, params))
+                    conn.execute('DELETE FROM sms' + where, params)
+                ids = sorted(set(ids or ()))
+                for i in range(0, len(ids), 500):
+                    chunk = ids[i:i + 500]
+                    where = ' WHERE ' + ' AND '.join(clauses + [f'id IN ({",".join("?" * len(chunk))})'])
+                    removed.extend(self._to_record(r) for r in conn.execute(self.SELECT + where, params + chunk))
+                    conn.execute('DELETE FROM sms' + where, params + chunk)
+                self._known = self._state(conn)
+            if removed:
+                self._emit('delete', removed)
+        return len(removed)
+
+    def clear(self):
+        """清空全部记录"""
+        with self._lock:
+            with self._transaction() as conn:
+                conn.execute('DELETE FROM sms')
+                self._known = self._state(conn)
+            self._emit('reset', [])
+
+    def compact(self):
+        """裁剪超出 max_entries 的旧记录（写入归档）并做 WAL checkpoint"""
+        if not self.max_entries:
+            with self._conn() as conn:
+                conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+            return False
+        with self._lock:
+            with self._transaction() as conn:
+                where = ' WHERE seq <= (SELECT seq FROM sms ORDER BY seq DESC LIMIT 1 OFFSET ?)'
+                trimmed = [self._to_record(r) for r in conn.execute(self.SELECT + where, (self.max_entries,))]
+                if trimmed and self.archive is not None:
+                    self.archive.append(trimmed)
+                if trimmed:
+                    conn.execute('DELETE FROM sms' + where, (self.max_entries,))
+                    self._known = self._state(conn)
+            if trimmed:
+                self._emit('delete', trimmed)
+        with self._conn() as conn:
+            conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+        return bool(trimmed)
+
+
+class SmsArchive:
+    """过期短信归档：按接收月份追加到 gzip 分段（sms-YYYY-MM.jsonl.gz）
+
+    每次追加写成一个独立的 gzip member 并 fsync，读取时多个 member 会被连成一个流；
+    崩溃留下的残缺 member 在读取时忽略。旁路索引 index.json 记录每个分段的
+    (文件大小, 条数, 最小 id, 最大 id)，查询时据此跳过不相关的分段、直接得到总数，
+    只解压真正需要的分段；索引缺失或与文件大小不符时扫描一次该分段重新统计。
+    """
+
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._index_sig = None
+        self._index = {}        # 分段文件名 -> [文件大小, 条数, 最小 id, 最大 id]
+        self._scanned = {}      # 分段文件名 -> 扫描得到的统计（索引缺失时）
+
+    @contextmanager
+    def _flock(self, name, blocking=True):
+        """归档目录下的进程间文件锁；非阻塞且已被占用时产出 False"""
+        os.makedirs(self.directory, exist_ok=True)
+        fd = os.open(os.path.join(self.directory, name), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+                except BlockingIOError:
+                    yield False
+                    return
+            yield True
+        finally:
+            os.close(fd)
+
+    def exclusive(self):
+        """执行保留策略的互斥锁（非阻塞），其他进程正在执行时产出 False"""
+        return self._flock('.retain.lock', blocking=False)
+
+    def _fsync_dir(self):
+        dir_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def _read_index(self):
+        path = os.path.join(self.directory, self.INDEX_FILE)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def append(self, records):
+        """把记录写入对应月份的分段并更新索引，返回时已落盘"""
+        by_month = {}
+        for record in records:
+            by_month.setdefault((record.get('received_at') or '')[:7] or 'unknown', []).append(record)
+        with self._flock('.lock'):
+            index = self._read_index()
+            for month, group in by_month.items():
+                name = f'sms-{month}.jsonl.gz'
+                path = os.path.join(self.directory, name)
+                stats = self._stats(name, index) if os.path.exists(path) else [0, 0, None, None]
+                data = ''.join(json.dumps(r, ensure_ascii=False) + '\n' for r in group).encode('utf-8')
+                with open(path, 'ab') as f:
+                    f.write(gzip.compress(data))
+                    f.flush()
+                    os.fsync(f.fileno())
+                    size = f.tell()
+                ids = [r.get('id', 0) for r in group]
+                index[name] = [size, stats[1] + len(group),
+                               min(ids) if stats[2] is None else min(stats[2], *ids),
+                               max(ids) if stats[3] is None else max(stats[3], *ids)]
+            tmp_file = os.path.join(self.directory, f'{self.INDEX_FILE}.{os.getpid()}.tmp')
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(index, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, os.path.join(self.directory, self.INDEX_FILE))
+            self._fsync_dir()
+        metrics.inc('sms_archived_total', len(records))
+
+    def _stats(self, name, index):
+        """分段的 [文件大小, 条数, 最小 id, 最大 id]；索引缺失或已过期时扫描一次"""
+        path = os.path.join(self.directory, name)
+        size = os.path.getsize(path)
+        stats = index.get(name)
+        if stats and stats[0] == size:
+            return stats
+        cached = self._scanned.get(name)
+        if cached and cached[0] == size:
+            return cached
+        ids = [r.get('id', 0) for r in self._read(path)]
+        stats = [size, len(ids), min(ids, default=None), max(ids, default=None)]
+        self._scanned[name] = stats
+        return stats
+
+    def _segments(self):
+        """全部分段 (文件名, 统计)，按最大 id 从新到旧"""
+        with self._lock:
+            sig = LogStore._file_sig(os.path.join(self.directory, self.INDEX_FILE))
+            if sig != self._index_sig:
+                self._index, self._index_sig = self._read_index(), sig
+            segments = []
+            for path in glob.glob(os.path.join(self.directory, 'sms-*.jsonl.gz')):
+                name = os.path.basename(path)
+                stats = self._stats(name, self._index)
+                if stats[1]:
+                    segments.append((name, stats))
+        segments.sort(key=lambda s: s[1][3], reverse=True)
+        return segments
+
+    @staticmethod
+    def _read(path):
+        records = []
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except (EOFError, gzip.BadGzipFile, OSError) as e:
+            logger.warning(f"归档分段 {path} 末尾不完整，已忽略: {e}")
+        return records
+
+    def _merge(self, segments, before_id, sender, exact):
+        """多个分段按 id 倒序归并；只有当分段的最大 id 可能排在当前候选之前时才解压它"""
+        heap, opened = [], 0
+        while heap or opened < len(segments):
+            while opened < len(segments) and (not heap or segments[opened][1][3] >= -heap[0][0]):
+                name = segments[opened][0]
+                opened += 1
+                records = [r for r in self._read(os.path.join(self.directory, name))
+                           if (before_id is None or r.get('id', 0) < before_id)
+                           and (not sender or BaseStore._sender_match(r, sender, exact))]
+                records.sort(key=lambda r: r.get('id', 0), reverse=True)
+                if records:
+                    heapq.heappush(heap, (-records[0].get('id', 0), opened, 0, records))
+            if not heap:
+                continue
+            _, order, i, records = heapq.heappop(heap)
+            yield records[i]
+            if i + 1 < len(records):
+                heapq.heappush(heap, (-records[i + 1].get('id', 0), order, i + 1, records))
+
+    def iter_desc(self, before_id=None, sender=None, exact=False):
+        """按 id 倒序逐条产出符合条件的归档记录（跳过最小 id 不小于 before_id 的分段）"""
+        segments = [s for s in self._segments() if before_id is None or s[1][2] < before_id]
+        return self._merge(segments, before_id, sender, exact)
+
+    def scan(self, before_id=None, limit=50, sender=None, exact=False):
+        """从 before_id 向旧翻一页，返回 (记录列表, 是否还有更多)"""
+        page = list(islice(self.iter_desc(before_id, sender, exact), max(limit, 0) + 1))
+        return page[:max(limit, 0)], len(page) > max(limit, 0)
+
+    def query(self, sender=None, exact=False, limit=50, offset=0):
+        """按发送者过滤并分页（倒序），返回 (总数, 当前页)
+
+        不过滤时总数取自索引，并整段跳过 offset 覆盖且 id 区间不与后续分段重叠的分段；
+        按发送者过滤时需要扫描全部分段，大量历史建议用游标翻页。
+        """
+        offset, limit = max(offset, 0), max(limit, 0)
+        segments = self._segments()
+        if sender:
+            total, page = 0, []
+            for record in self._merge(segments, None, sender, exact):
+                if offset <= total < offset + limit:
+                    page.append(record)
+                total += 1
+            return total, page
+        total = sum(stats[1] for _, stats in segments)
+        start = 0
+        while (start + 1 < len(segments) and segments[start][1][1] <= offset
+               and segments[start + 1][1][3] < segments[start][1][2]):
+            offset -= segments[start][1][1]
+            start += 1
+        return total, list(islice(self._merge(segments[start:], None, None, False), offset, offset + limit))
+
+
+class SmsIdAllocator:
+    """多个分区共享的 id 分配器：记录已分配的最大 id，保证各分区分配的 id 互不相同
+
+    计数保存在一个 8 字节的文件中，进程间用 fcntl 文件锁互斥，临界区只有一次读写，分区之间几乎不争用。
+    不 fsync：进程崩溃时计数仍在页缓存中；掉电回退的那部分 id 也早已小于重启后的毫秒时间戳。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._fd = None
+        self._pid = None
+
+    def allocate(self, last_id, count):
+        """分配 count 个递增 id，均大于 last_id 与此前任何分区分配过的 id"""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                self._pid = os.getpid()
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                data = os.read(self._fd, 8)
+                last_id = max(last_id, int.from_bytes(data, 'little') if len(data) == 8 else 0)
+                ids = []
+                for _ in range(count):
+                    last_id = next_sms_id(last_id)
+                    ids.append(last_id)
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                os.write(self._fd, last_id.to_bytes(8, 'little'))
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return ids
+
+
+def record_id(record):
+    return record.get('id', 0)
+
+
+def merge_pages(pages, limit, offset=0, reverse=True):
+    """把各分区按 id 排好序的页做 k 路归并，取 [offset, offset + limit)"""
+    merged = heapq.merge(*pages, key=record_id, reverse=reverse)
+    return list(islice(merged, max(offset, 0), max(offset, 0) + max(limit, 0)))
+
+
+class MergedArchive:
+    """多个分区归档的只读合并视图，查询接口同 SmsArchive"""
+
+    def __init__(self, archives):
+        self.archives = archives
+
+    def iter_desc(self, before_id=None, sender=None, exact=False):
+        return heapq.merge(*(a.iter_desc(before_id, sender, exact) for a in self.archives),
+                           key=record_id, reverse=True)
+
+    def scan(self, before_id=None, limit=50, sender=None, exact=False):
+        """从 before_id 向旧翻一页，返回 (记录列表, 是否还有更多)"""
+        page = list(islice(self.iter_desc(before_id, sender, exact), max(limit, 0) + 1))
+        return page[:max(limit, 0)], len(page) > max(limit, 0)
+
+    def query(self, sender=None, exact=False, limit=50, offset=0):
+        """按发送者过滤并分页（倒序），返回 (总数, 当前页)"""
+        need = max(limit, 0) + max(offset, 0)
+        results = [a.query(sender, exact, need, 0) for a in self.archives]
+        return sum(total for total, _ in results), merge_pages([page for _, page in results], limit, offset)
+
+
+class PartitionedStore(BaseStore):
+    """按设备分区的存储：每台设备一个独立的存储（各自的文件、锁、WAL、去重表与检索索引），写入互不争用
+
+    读接口与单个存储相同，跨分区的结果按 id 做 k 路归并（heapq.merge）；各分区的 id 由共享的
+    SmsIdAllocator 分配、全局唯一，按 id 的游标翻页、删除、导出在合并视图上同样成立。
+    写入按记录的 device 字段路由到分区（没有时为 default 分区）；partition(device) 取单台设备的分区。
+    新短信同时发布到分区自己的推送通道和合并视图的推送通道。
+    """
+
+    def __init__(self, partitions):
+        super().__init__()
+        self.partitions = partitions    # 设备 id -> 存储
+        self._indexes = [self.feed]
+        for part in partitions.values():
+            part._indexes.append(self.feed)
+        archives = [p.archive for p in partitions.values() if p.archive is not None]
+        self.archive = MergedArchive(archives) if archives else None
+
+    def _route(self, records):
+        """按设备分组，返回 {设备 id: [records 中的下标]}"""
+        groups = {}
+        for i, record in enumerate(records):
+            device = record.get('device') or DEFAULT_DEVICE
+            if device not in self.partitions:
+                raise ValueError(f"Unknown device: {device}")
+            groups.setdefault(device, []).append(i)
+        return groups
+
+    def sync(self):
+        for part in self.partitions.values():
+            part.sync()
+
+    def load(self):
+        """读取全部记录（按 id 归并）"""
+        return list(heapq.merge(*(p.load() for p in self.partitions.values()), key=record_id))
+
+    def count(self):
+        return sum(p.count() for p in self.partitions.values())
+
+    def get(self, sms_id):
+        for part in self.partitions.values():
+            record = part.get(sms_id)
+            if record is not None:
+                return record
+        return None
+
+    def recent(self, limit, offset=0):
+        need = max(limit, 0) + max(offset, 0)
+        return merge_pages([p.recent(need) for p in self.partitions.values()], limit, offset)
+
+    def query(self, sender=None, exact=False, limit=50, offset=0):
+        need = max(limit, 0) + max(offset, 0)
+        results = [p.query(sender, exact, need, 0) for p in self.partitions.values()]
+        return sum(total for total, _ in results), merge_pages([page for _, page in results], limit, offset)
+
+    def scan(self, before_id=None, after_id=None, limit=50, sender=None, exact=False):
+        results = [p.scan(before_id, after_id, limit, sender, exact) for p in self.partitions.values()]
+        page = merge_pages([page for page, _ in results], limit, reverse=after_id is None)
+        return page, any(more for _, more in results) or sum(len(p) for p, _ in results) > len(page)
+
+    def iter_records(self, ids=None, sender=None, exact=False, start=None, end=None):
+        return heapq.merge(*(p.iter_records(ids, sender, exact, start, end) for p in self.partitions.values()),
+                           key=record_id)
+
+    def stats_snapshots(self):
+        return [snap for p in self.partitions.values() for snap in p.stats_snapshots()]
+
+    def save_stats(self):
+        for part in self.partitions.values():
+            part.save_stats()
+
+    def latest_code(self, sender=None, brand=None, since=None):
+        found = [p.latest_code(sender, brand, since) for p in self.partitions.values()]
+        return max((r for r in found if r is not None), key=record_id, default=None)
+
+    def search(self, query, limit=50, offset=0):
+        """各分区分别检索，按 (得分, id) 归并"""
+        parts = list(self.partitions.values())
+        ranked = [[(score, sms_id, i) for score, sms_id in p.ranked(query)] for i, p in enumerate(parts)]
+        hits = list(islice(heapq.merge(*ranked, reverse=True), max(offset, 0), max(offset, 0) + max(limit, 0)))
+        records = [parts[i].get(sms_id) for _, sms_id, i in hits]
+        return sum(len(r) for r in ranked), [r for r in records if r is not None]
+
+    def append(self, record):
+        self.extend([record])
+
+    def extend(self, records, dedup=False):
+        """按设备把记录写入各自的分区，返回与 records 一一对应的是否重复"""
+        duplicates = [False] * len(records)
+        for device, indexes in self._route(records).items():
+            results = self.partitions[device].extend([records[i] for i in indexes], dedup=dedup)
+            for i, duplicate in zip(indexes, results):
+                duplicates[i] = duplicate
+        return duplicates
+
+    def replace(self, logs):
+        groups = self._route(logs)
+        for device, part in self.partitions.items():
+            part.replace([logs[i] for i in groups.get(device, ())])
+
+    def delete(self, ids=None, sender=None, exact=False, start=None, end=None):
+        return sum(p.delete(ids, sender, exact, start, end) for p in self.partitions.values())
+
+    def clear(self):
+        for part in self.partitions.values():
+            part.clear()
+
+    def compact(self):
+        return any([p.compact() for p in self.partitions.values()])
+
+    def retain(self):
+        return sum(p.retain() for p in self.partitions.values())
+
+    def start_compactor(self):
+        for part in self.partitions.values():
+            part.start_compactor()
+
+
+DEFAULT_DEVICE = 'default'   # API_KEY 推送的短信所在的分区
+DEVICE_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+
+def partition_file(path, device):
+    """设备分区的文件名：default 分区沿用原文件名，其他设备在扩展名前加设备 id（sms_log.json -> sms_log.box1.json）"""
+    if device == DEFAULT_DEVICE:
+        return path
+    base, ext = os.path.splitext(path)
+    return f"{base}.{device}{ext}"
+
+
+def create_partition(device=DEFAULT_DEVICE):
+    """按 STORAGE_BACKEND 创建一个分区的存储，并挂上归档与保留策略"""
+    if STORAGE_BACKEND == 'sqlite':
+        target = SqliteLogStore(partition_file(SQLITE_DB_FILE, device), SQLITE_MAX_ENTRIES)
+    elif STORAGE_BACKEND == 'packed':
+        target = PackedLogStore(partition_file(PACKED_LOG_FILE, device), partition_file(PACKED_WAL_FILE, device),
+                                PACKED_MAX_ENTRIES)
+    else:
+        target = LogStore(partition_file(SMS_LOG_FILE, device), partition_file(SMS_WAL_FILE, device),
+                          MAX_LOG_ENTRIES)
+    if ARCHIVE_DIR:
+        target.archive = SmsArchive(ARCHIVE_DIR if device == DEFAULT_DEVICE else os.path.join(ARCHIVE_DIR, device))
+    target.stats_index.path = partition_file(SMS_STATS_FILE, device)
+    target.max_age_days = RETENTION_MAX_AGE_DAYS
+    target.max_bytes = RETENTION_MAX_BYTES
+    return target
+
+
+def create_store():
+    """创建存储：未配置 DEVICES 时为单个存储，否则每台设备一个分区，合并为 PartitionedStore"""
+    if not DEVICES:
+        return create_partition()
+    devices = [DEFAULT_DEVICE] + sorted(set(DEVICES.values()) - {DEFAULT_DEVICE})
+    invalid = [d for d in devices if not DEVICE_ID_PATTERN.fullmatch(d)]
+    if invalid:
+        raise ValueError(f"设备 id 只能包含字母、数字、下划线和连字符: {invalid}")
+    id_source = SmsIdAllocator(SMS_ID_FILE)
+    partitions = {}
+    for device in devices:
+        partitions[device] = create_partition(device)
+        partitions[device].id_source = id_source
+    return PartitionedStore(partitions)
+
+
+def import_json_logs(path, target):
+    """把旧版 sms_log.json（及同名 .wal）导入到 target 存储，返回导入条数"""
+    wal_file = os.path.splitext(path)[0] + '.wal'
+    records = LogStore(path, wal_file, max_entries=sys.maxsize).load()
+    existing = {(l.get('id'), l.get('sender'), l.get('message')) for l in target.load()}
+    records = [r for r in records if (r.get('id'), r.get('sender'), r.get('message')) not in existing]
+    if records:
+        target.extend(records)
+    return len(records)
+
+
+store = create_store()
 
-app = Flask(__name__)
-app.secret_key = SECRET_KEY
 
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
-logger = logging.getLogger(__name__)
+# ==================== 下游转发 ====================
 
+class ForwardDispatcher:
+    """把新短信异步转发到下游 Webhook
 
-def get_china_time():
-    """获取中国时间"""
-    return datetime.now(CHINA_TZ).strftime('%Y-%m-%d %H:%M:%S')
+    接收接口只把任务放进有界内存队列（满了则写入重试文件），不等待下游；
+    转发线程各自复用 keep-alive 连接。失败的任务按指数退避写入持久化重试队列，
+    由持有 owner 文件锁的那个进程统一调度，多 worker 部署时不会重复投递。
+    """
 
+    def __init__(self, webhooks, workers, queue_size, retry_file):
+        self.webhooks = [w if isinstance(w, dict) else {"url": w} for w in webhooks]
+        self.workers = workers
+        self.retry_file = retry_file
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._started = False
+        self._owner_fd = None
 
-def verify_api_key():
-    """验证 API Key（用于 ESP32 推送）"""
-    if not API_KEY:
+    def submit(self, records):
+        """为每条记录、每个 Webhook 生成一个转发任务，立即返回"""
+        if not self.webhooks:
+            return
+        self.start()
+        spilled = []
+        for record in records:
+            for hook in self.webhooks:
+                job = {"job_id": uuid.uuid4().hex, "url": hook["url"], "format": hook.get("format", "json"),
+                       "record": record, "attempt": 0, "due": 0}
+                try:
+                    self._queue.put_nowait(job)
+                except queue.Full:
+                    spilled.append(job)
+        if spilled:
+            logger.warning(f"转发队列已满，{len(spilled)} 个任务转入重试队列")
+            self._append_retries(spilled)
+
+    def start(self):
+        """启动转发线程与重试调度线程（只启动一次）"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        for i in range(self.workers):
+            threading.Thread(target=self._worker_loop, name=f'forward-{i}', daemon=True).start()
+        threading.Thread(target=self._retry_loop, name='forward-retry', daemon=True).start()
+
+    @staticmethod
+    def _payload(job):
+        record = job["record"]
+        if job["format"] == "wecom":
+            content = f"📨 {record.get('sender')}\n{record.get('message')}\n⏰ {record.get('received_at')}"
+            return {"msgtype": "text", "text": {"content": content}}
+        return record
+
+    def _connection(self, url):
+        """当前线程到目标主机的 keep-alive 连接"""
+        pool = getattr(self._local, 'pool', None)
+        if pool is None:
+            pool = self._local.pool = {}
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        conn = pool.get(key)
+        if conn is None:
+            cls = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+            conn = pool[key] = cls(parts.netloc, timeout=FORWARD_TIMEOUT)
+        return key, conn, parts
+
+    def deliver(self, job):
+        """投递一次，返回是否成功（2xx）"""
+        key, conn, parts = self._connection(job["url"])
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        body = json.dumps(self._payload(job), ensure_ascii=False).encode('utf-8')
+        try:
+            conn.request('POST', path, body, {'Content-Type': 'application/json; charset=utf-8'})
+            resp = conn.getresponse()
+            resp.read()
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            self._local.pool.pop(key, None)
+            logger.warning(f"转发失败 {job['url']}: {e}")
+            return False
+        if resp.will_close:
+            conn.close()
+            self._local.pool.pop(key, None)
+        if 200 <= resp.status < 300:
+            return True
+        logger.warning(f"转发失败 {job['url']}: HTTP {resp.status}")
+        return False
+
+    def _worker_loop(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if not self.deliver(job):
+                    self._schedule_retry(job)
+            except Exception as e:
+                logger.error(f"转发异常: {e}")
+                self._schedule_retry(job)
+
+    def _schedule_retry(self, job):
+        job = dict(job, attempt=job["attempt"] + 1)
+        if job["attempt"] > FORWARD_MAX_RETRIES:
+            logger.error(f"转发放弃（已重试 {FORWARD_MAX_RETRIES} 次）: {job['url']} id={job['record'].get('id')}")
+            return
+        job["due"] = time.time() + FORWARD_RETRY_BASE * 2 ** (job["attempt"] - 1)
+        self._append_retries([job])
+
+    @contextmanager
+    def _retry_file_locked(self):
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            fd = os.open(self.retry_file + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)
+
+    def drain(self):
+        """退出前把内存队列中尚未转发的任务写入重试队列，由下次启动或其他 worker 继续投递"""
+        jobs = []
+        while True:
+            try:
+                jobs.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if jobs:
+            self._append_retries(jobs)
+            logger.info(f"{len(jobs)} 个未完成的转发任务已转入重试队列")
+
+    def _append_retries(self, jobs):
+        data = ''.join(json.dumps(j, ensure_ascii=False) + '\n' for j in jobs)
+        with self._retry_file_locked():
+            with open(self.retry_file, 'a', encoding='utf-8') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _is_owner(self):
+        """是否由本进程调度重试队列（非阻塞地抢占 owner 锁，抢到后一直持有）"""
+        if fcntl is None:
+            return True
+        if self._owner_fd is None:
+            fd = os.open(self.retry_file + '.owner', os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return False
+            self._owner_fd = fd
         return True
-    key = request.headers.get('X-API-Key') or request.args.get('api_key')
-    return key == API_KEY
 
+    def _take_due(self):
+        """从重试文件中取出到期且能放进内存队列的任务，其余写回"""
+        with self._retry_file_locked():
+            try:
+                with open(self.retry_file, 'r', encoding='utf-8') as f:
+                    lines = f.readlines()
+            except FileNotFoundError:
+                return 0
+            now, remaining, taken = time.time(), [], 0
+            for line in lines:
+                try:
+                    job = json.loads(line)
+                except ValueError:
+                    continue
+                if job.get("due", 0) <= now:
+                    try:
+                        self._queue.put_nowait(job)
+                        taken += 1
+                        continue
+                    except queue.Full:
+                        pass
+                remaining.append(line if line.endswith('\n') else line + '\n')
+            if taken:
+                tmp_file = f"{self.retry_file}.{os.getpid()}.tmp"
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    f.writelines(remaining)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_file, self.retry_file)
+            return taken
 
-def login_required(f):
-    """Web 页面登录验证装饰器"""
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if not session.get('logged_in'):
-            return redirect(url_for('login'))
-        return f(*args, **kwargs)
-    return decorated_function
+    def _retry_loop(self):
+        while True:
+            time.sleep(1)
+            try:
+                if self._is_owner():
+                    self._take_due()
+            except Exception as e:
+                logger.error(f"调度转发重试失败: {e}")
+
+    def pending(self):
+        """(内存队列中的任务数, 重试文件中的任务数)"""
+        try:
+            with open(self.retry_file, 'r', encoding='utf-8') as f:
+                retries = sum(1 for _ in f)
+        except FileNotFoundError:
+            retries = 0
+        return self._queue.qsize(), retries
+
+
+forwarder = ForwardDispatcher(FORWARD_WEBHOOKS, FORWARD_WORKERS, FORWARD_QUEUE_SIZE, FORWARD_RETRY_FILE)
+
+
+# ==================== 接收限流 ====================
 
+class RateLimiter:
+    """令牌桶限流：每个键（设备）一个桶，按 rate 个/秒补充，最多攒 burst 个
 
-def load_logs():
-    """加载短信记录"""
-    if os.path.exists(SMS_LOG_FILE):
+    桶里至少有一个令牌时放行，批量推送按条数扣减，可以扣成负数（欠账还清之前后续请求被拒绝），
+    这样一次补推的积压不会被拒绝，持续刷屏的设备又会被压到 rate 以下。
+    默认桶保存在进程内存中（有界 LRU），多 worker 部署时实际上限约为 worker 数倍；
+    给出 state_file 时桶保存在 SQLite 文件中由所有 worker 共享，每次判定一个短事务。
+    共享状态读写失败时放行并记录日志，限流不影响正常接收。
+    """
+
+    SCHEMA = 'CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)'
+
+    def __init__(self, rate, burst, state_file=None, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.state_file = state_file
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()   # key -> (令牌数, 更新时间)
+        self._conn = None
+        self._conn_pid = None
+        self._ops = 0
+
+    def _refill(self, bucket, now):
+        if bucket is None:
+            return self.burst
+        tokens, updated = bucket
+        return min(self.burst, tokens + max(now - updated, 0) * self.rate)
+
+    def _take(self, tokens, cost, force):
+        """返回 (扣减后的令牌数, 需要等待的秒数)"""
+        if not force and tokens < 1:
+            return tokens, (1 - tokens) / self.rate
+        return tokens - cost, 0
+
+    def _update_memory(self, key, cost, force):
+        now = time.monotonic()
+        with self._lock:
+            tokens, wait = self._take(self._refill(self._buckets.get(key), now), cost, force)
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def _update_shared(self, key, cost, force):
+        now = time.time()   # 跨进程比较，只能用墙上时钟
+        with self._lock:
+            if self._conn_pid != os.getpid():
+                self._conn = sqlite3.connect(self.state_file, timeout=5, isolation_level=None,
+                                             check_same_thread=False)
+                self._conn.execute('PRAGMA journal_mode=WAL')
+                self._conn.execute('PRAGMA synchronous=OFF')   # 限流状态丢了只是重新计数，不需要落盘
+                self._conn.execute(self.SCHEMA)
+                self._conn_pid = os.getpid()
+            conn = self._conn
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+                tokens, wait = self._take(self._refill(row, now), cost, force)
+                conn.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)',
+                             (key, tokens, now))
+                self._ops += 1
+                if self._ops % 1000 == 0:
+                    # 早已回满的桶和不存在没有区别
+                    conn.execute('DELETE FROM buckets WHERE updated < ?', (now - self.burst / self.rate,))
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        return wait
+
+    def _update(self, key, cost, force):
+        if not self.rate:
+            return 0
+        if not self.state_file:
+            return self._update_memory(key, cost, force)
         try:
-            with open(SMS_LOG_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except (json.JSONDecodeError, IOError):
-            return []
-    return []
+            return self._update_shared(key, cost, force)
+        except sqlite3.Error as e:
+            logger.warning(f"读写限流状态失败，本次放行: {e}")
+            return 0
+
+    def acquire(self, key):
+        """尝试放行一个请求并扣一个令牌；返回 0 表示放行，否则为建议的重试等待秒数"""
+        return self._update(key, 1, False)
+
+    def charge(self, key, cost):
+        """已放行的请求额外扣减 cost 个令牌（批量推送按条数计）"""
+        if cost > 0:
+            self._update(key, cost, True)
+
+
+limiter = RateLimiter(RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST, RATE_LIMIT_STATE_FILE or None)
+
+
+# ==================== 请求耗时统计 ====================
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
 
 
-def save_logs(logs):
-    """保存短信记录"""
-    if len(logs) > MAX_LOG_ENTRIES:
-        logs = logs[-MAX_LOG_ENTRIES:]
-    with open(SMS_LOG_FILE, 'w', encoding='utf-8') as f:
-        json.dump(logs, f, ensure_ascii=False, indent=2)
+@app.after_request
+def record_request_duration(response):
+    start = g.get('request_start')
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('http_request_duration_seconds', time.perf_counter() - start,
+                        route=route, method=request.method, status=response.status_code)
+    return response
 
 
 # ==================== 登录相关 ====================
@@ -101,7 +2729,7 @@ def login():
             error = "用户名或密码错误"
             logger.warning(f"登录失败，IP: {request.remote_addr}")
     
-    return render_template_string(LOGIN_TEMPLATE, error=error)
+    return render_template(LOGIN_PAGE, error=error)
 
 
 @app.route('/logout')
@@ -113,54 +2741,182 @@ def logout():
 
 # ==================== API 接口 ====================
 
-@app.route('/sms', methods=['POST'])
-def receive_sms():
-    """接收短信推送（ESP32 调用）"""
+def validate_sms_item(item):
+    """校验一条推送数据，返回错误信息，合法时返回 None"""
+    if not isinstance(item, dict) or not item:
+        return "Invalid JSON"
+    for field in ('sender', 'message', 'timestamp', 'idempotency_key'):
+        if field in item and item[field] is not None and not isinstance(item[field], str):
+            return f"Field '{field}' must be a string"
+    if len(item.get('message') or '') > MAX_MESSAGE_LENGTH:
+        return f"Field 'message' is too long (max {MAX_MESSAGE_LENGTH} characters)"
+    return None
+
+
+def rate_limit_key():
+    """限流键：设备 Key 对应的设备 id，其次是 X-Device-Id，都没有时按来源 IP"""
+    device = g.get('device') or request.headers.get('X-Device-Id')
+    return 'device:' + device if device else 'ip:' + (request.remote_addr or '')
+
+
+def request_store(device=None):
+    """请求对应的存储视图，设备不存在时返回 None
+
+    设备 Key 只能访问本设备的分区；API_KEY 与 Web 会话可用 device 参数选择某台设备，缺省为全部设备的合并视图。
+    """
+    return store.partition(g.get('device') or device or request.args.get('device'))
+
+
+def unknown_device():
+    return jsonify({"status": "error", "message": "Unknown device"}), 404
+
+
+def payload_too_large():
+    metrics.inc('sms_rejected_total', reason='too_large')
+    return jsonify({"status": "error", "message": f"Request body too large (max {MAX_CONTENT_LENGTH} bytes)"}), 413
+
+
+def check_ingest_request():
+    """接收接口在解析 JSON 之前的检查：API Key、请求体大小、限流；通过时返回 None，否则返回错误响应
+
+    先只看请求头和令牌桶，被拒绝的请求不读取、不解析请求体，也不会触发存储写入。
+    """
     if not verify_api_key():
         logger.warning(f"API Key 验证失败，来源 IP: {request.remote_addr}")
         return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    if request.content_length is not None and request.content_length > MAX_CONTENT_LENGTH:
+        return payload_too_large()
+    retry_after = limiter.acquire(rate_limit_key())
+    if retry_after:
+        metrics.inc('sms_rejected_total', reason='rate_limited')
+        return (jsonify({"status": "error", "message": "Too many requests"}), 429,
+                {'Retry-After': str(math.ceil(retry_after))})
+    try:
+        # 分块传输没有 Content-Length，读取到 MAX_CONTENT_LENGTH 为止（视 Werkzeug 版本截断或抛出 413）
+        body = request.get_data(cache=True)
+    except RequestEntityTooLarge:
+        return payload_too_large()
+    if request.content_length is None and len(body) >= MAX_CONTENT_LENGTH:
+        return payload_too_large()
+    return None
+
+
+def ingest_sms(items, client_ip, device=''):
+    """写入一批已校验的推送数据（单条与批量共用）
+
+    一次写入存储（多设备部署时写入 device 的分区）；去重（包括同一批内的重复）由存储在写锁内完成，
+    多 worker 部署同样有效。返回与 items 一一对应的 (id, 是否重复)。
+    """
+    received_at = get_china_time()  # 使用中国时间
+    records = []
+    for item in items:
+        record = {
+            "id": None,  # 由存储在写锁内分配，保证唯一且递增
+            "sender": item.get('sender') or 'unknown',
+            "message": item.get('message') or '',
+            "pdu_timestamp": item.get('timestamp') or '',
+            "received_at": received_at,
+            "client_ip": client_ip
+        }
+        if item.get('idempotency_key'):
+            record["idempotency_key"] = item['idempotency_key']
+        if device:
+            record["device"] = device
+        record.update(extractor.extract(record["message"]))
+        records.append(record)
+    duplicates = store.extend(records, dedup=bool(DEDUP_TTL))
+    results = list(zip(records, duplicates))
+    forwarder.submit([record for record, duplicate in results if not duplicate])
+    
+    for record, duplicate in results:
+        metrics.inc('sms_duplicates_total' if duplicate else 'sms_ingested_total', client_ip=client_ip)
+        if duplicate:
+            logger.info(f"重复推送，已忽略 | 原 id: {record['id']}")
+        else:
+            message = record['message']
+            logger.info(f"收到短信 | 发送者: {record['sender']} | 内容: {message[:50]}{'...' if len(message) > 50 else ''}")
+    return [(record["id"], duplicate) for record, duplicate in results]
+
+
+@app.route('/sms', methods=['POST'])
+def receive_sms():
+    """接收短信推送（ESP32 调用）"""
+    rejected = check_ingest_request()
+    if rejected:
+        return rejected
     
     try:
-        data = request.get_json()
-        if not data:
-            return jsonify({"status": "error", "message": "Invalid JSON"}), 400
+        data = request.get_json(silent=True)
+        error = validate_sms_item(data)
+        if error:
+            return jsonify({"status": "error", "message": error}), 400
         
-        sender = data.get('sender', 'unknown')
-        message = data.get('message', '')
-        timestamp = data.get('timestamp', '')
+        if request.headers.get('Idempotency-Key'):
+            data = dict(data, idempotency_key=request.headers['Idempotency-Key'])
+        (sms_id, duplicate), = ingest_sms([data], request.remote_addr, g.device)
         
-        record = {
-            "id": int(datetime.now().timestamp() * 1000),
-            "sender": sender,
-            "message": message,
-            "pdu_timestamp": timestamp,
-            "received_at": get_china_time(),  # 使用中国时间
-            "client_ip": request.remote_addr
-        }
+        if duplicate:
+            return jsonify({"status": "ok", "id": sms_id, "duplicate": True}), 200
+        return jsonify({"status": "ok", "id": sms_id}), 200
         
-        logs = load_logs()
-        logs.append(record)
-        save_logs(logs)
+    except Exception as e:
+        logger.error(f"处理短信失败: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+@app.route('/sms/batch', methods=['POST'])
+def receive_sms_batch():
+    """批量接收短信推送（设备重连后一次上报积压的短信）
+
+    请求体为数组或 {"items": [...]}；任一条不合法则整批拒绝，全部合法时一次写入存储。
+    限流按条数计：放行时扣一个令牌，写入前再扣掉其余条数。
+    """
+    rejected = check_ingest_request()
+    if rejected:
+        return rejected
+    
+    try:
+        data = request.get_json(silent=True)
+        items = data.get('items') if isinstance(data, dict) else data
+        if not isinstance(items, list) or not items:
+            return jsonify({"status": "error", "message": "Invalid JSON"}), 400
+        if len(items) > BATCH_MAX_ITEMS:
+            return jsonify({"status": "error", "message": f"Too many items (max {BATCH_MAX_ITEMS})"}), 413
         
-        logger.info(f"收到短信 | 发送者: {sender} | 内容: {message[:50]}{'...' if len(message) > 50 else ''}")
+        errors = [{"index": i, "message": e} for i, e in enumerate(map(validate_sms_item, items)) if e]
+        if errors:
+            return jsonify({"status": "error", "message": "Invalid items", "errors": errors}), 400
         
-        return jsonify({"status": "ok", "id": record["id"]}), 200
+        limiter.charge(rate_limit_key(), len(items) - 1)
+        results = ingest_sms(items, request.remote_addr, g.device)
+        return jsonify({
+            "status": "ok",
+            "results": [{"index": i, "id": sms_id, "status": "duplicate" if duplicate else "ok"}
+                        for i, (sms_id, duplicate) in enumerate(results)]
+        }), 200
         
     except Exception as e:
-        logger.error(f"处理短信失败: {e}")
+        logger.error(f"批量处理短信失败: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
 @app.route('/sms', methods=['GET'])
 def list_sms():
-    """查询短信记录（API）"""
+    """查询短信记录（API）；device 参数只看一台设备，缺省为全部设备按 id 归并"""
     if not verify_api_key():
         return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    target = request_store()
+    if target is None:
+        return unknown_device()
     
-    logs = load_logs()
     sender_filter = request.args.get('sender')
-    if sender_filter:
-        logs = [l for l in logs if sender_filter in l.get('sender', '')]
+    exact = request.args.get('exact') in ('1', 'true')
+    include_archive = request.args.get('include_archive') in ('1', 'true') and target.archive is not None
+    
+    if 'since_id' in request.args:
+        return long_poll_sms(target)
+    if 'before_id' in request.args or 'after_id' in request.args:
+        return list_sms_by_cursor(target, sender_filter, exact, include_archive)
     
     try:
         limit = int(request.args.get('limit', 50))
@@ -168,12 +2924,147 @@ def list_sms():
     except ValueError:
         limit, offset = 50, 0
     
-    logs = logs[::-1]
-    total = len(logs)
-    logs = logs[offset:offset + limit]
+    total, logs = target.query(sender_filter, exact=exact, limit=limit, offset=offset)
+    if include_archive:
+        # 归档中的记录都比在线库旧，接在在线库结果之后分页
+        archived, page = target.archive.query(sender_filter, exact=exact, limit=max(limit, 0) - len(logs),
+                                              offset=max(offset - total, 0))
+        total += archived
+        logs += page
+    
+    return jsonify({
+        "status": "ok",
+        "total": total,
+        "limit": limit,
+        "offset": offset,
+        "data": logs
+    })
+
+
+def list_sms_by_cursor(target, sender_filter, exact, include_archive=False):
+    """游标翻页：before_id 向旧翻、after_id 向新翻（轮询方用上次的 next_cursor 续读），流式输出 JSON
+
+    include_archive 时向旧翻到在线库末尾后继续翻归档。
+    """
+    try:
+        limit = max(int(request.args.get('limit', 50)), 0)
+        before_id = request.args.get('before_id') or None
+        after_id = request.args.get('after_id') or None
+        before_id = int(before_id) if before_id is not None else None
+        after_id = int(after_id) if after_id is not None else None
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid cursor"}), 400
+    
+    logs, has_more = target.scan(before_id=before_id, after_id=after_id, limit=limit,
+                                 sender=sender_filter, exact=exact)
+    if include_archive and after_id is None and not has_more and len(logs) < limit:
+        more, has_more = target.archive.scan(before_id=logs[-1]['id'] if logs else before_id,
+                                             limit=limit - len(logs), sender=sender_filter, exact=exact)
+        logs += more
+    next_cursor = logs[-1]['id'] if logs else (after_id if after_id is not None else before_id)
+    
+    def generate():
+        head = {"status": "ok", "limit": limit, "has_more": has_more, "next_cursor": next_cursor}
+        yield json.dumps(head, ensure_ascii=False)[:-1] + ', "data": ['
+        for i, record in enumerate(logs):
+            yield (', ' if i else '') + json.dumps(record, ensure_ascii=False)
+        yield ']}'
+    
+    return Response(generate(), mimetype='application/json')
+
+
+def current_last_id(target):
+    """当前最新一条短信的 id"""
+    latest = target.recent(1)
+    return latest[0]['id'] if latest else 0
+
+
+# SSE / 长轮询连接各占一个线程，超过上限时返回 503，保证接收短信总有空闲线程
+stream_slots = threading.BoundedSemaphore(STREAM_MAX_CONNECTIONS)
+
+
+def stream_busy():
+    return jsonify({"status": "error", "message": "Too many streaming connections"}), 503, {'Retry-After': '10'}
+
+
+def long_poll_sms(target):
+    """长轮询：返回 id 大于 since_id 的新短信，没有时挂起等待（wait 秒，默认 25）"""
+    try:
+        since_id = request.args.get('since_id') or None
+        since_id = int(since_id) if since_id is not None else current_last_id(target)
+        wait = min(max(float(request.args.get('wait', 25)), 0), LONG_POLL_MAX_WAIT)
+        limit = max(int(request.args.get('limit', 100)), 1)
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid parameters"}), 400
+    
+    if not stream_slots.acquire(blocking=False):
+        return stream_busy()
+    try:
+        logs = target.wait_new(since_id, wait, limit)
+    finally:
+        stream_slots.release()
+    return jsonify({
+        "status": "ok",
+        "next_cursor": logs[-1]['id'] if logs else since_id,
+        "data": logs
+    })
+
+
+@app.route('/sms/stream', methods=['GET'])
+def stream_sms():
+    """SSE 推送新短信（API Key 或已登录的 Web 会话均可订阅）
+
+    从 since_id（或断线重连时的 Last-Event-ID）之后开始推送，缺省只推送之后的新短信。
+    """
+    if not (session.get('logged_in') or verify_api_key()):
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    feed_store = request_store()
+    if feed_store is None:
+        return unknown_device()
+    try:
+        since_id = request.headers.get('Last-Event-ID') or request.args.get('since_id') or None
+        since_id = int(since_id) if since_id is not None else current_last_id(feed_store)
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid since_id"}), 400
+    if not stream_slots.acquire(blocking=False):
+        return stream_busy()
+    
+    def generate():
+        last_id = since_id
+        yield 'retry: 3000\n\n'
+        while not feed_store.feed.closed:  # 服务退出时结束连接，客户端会自动重连到其他 worker
+            records = feed_store.wait_new(last_id, 15)
+            if not records:
+                yield ': keepalive\n\n'
+                continue
+            for record in records:
+                last_id = record['id']
+                yield f"id: {last_id}\nevent: sms\ndata: {json.dumps(record, ensure_ascii=False)}\n\n"
+    
+    response = Response(generate(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(stream_slots.release)  # 连接断开时归还名额
+    return response
+
+
+def search_response():
+    """全文检索的公共实现：q 为关键词（空格分隔多个），按相关度分页返回"""
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({"status": "error", "message": "Missing q"}), 400
+    try:
+        limit = int(request.args.get('limit', 50))
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        limit, offset = 50, 0
+    target = request_store()
+    if target is None:
+        return unknown_device()
     
+    total, logs = target.search(query, limit=limit, offset=offset)
     return jsonify({
         "status": "ok",
+        "q": query,
         "total": total,
         "limit": limit,
         "offset": offset,
@@ -181,48 +3072,147 @@ def list_sms():
     })
 
 
+@app.route('/sms/search', methods=['GET'])
+def search_sms():
+    """全文检索短信（API）"""
+    if not verify_api_key():
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    return search_response()
+
+
+@app.route('/sms/latest-code', methods=['GET'])
+def latest_code():
+    """最新验证码（从内存索引回答）：sender 精确匹配发送者，brand 匹配签名，max_age 为最长接收时间（秒）
+
+    均可省略；没有符合条件的验证码时返回 404。
+    """
+    if not verify_api_key():
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    target = request_store()
+    if target is None:
+        return unknown_device()
+    since = None
+    if request.args.get('max_age'):
+        try:
+            max_age = float(request.args['max_age'])
+        except ValueError:
+            return jsonify({"status": "error", "message": "Invalid max_age"}), 400
+        since = (datetime.now(CHINA_TZ) - timedelta(seconds=max_age)).strftime('%Y-%m-%d %H:%M:%S')
+    
+    record = target.latest_code(request.args.get('sender') or None, request.args.get('brand') or None, since)
+    if record is None:
+        return jsonify({"status": "error", "message": "No code found"}), 404
+    return jsonify({"status": "ok", "code": record['code'], "data": record})
+
+
+@app.route('/api/sms/list', methods=['GET'])
+@login_required
+def list_sms_web():
+    """按 id 游标分页查询短信（Web 界面）"""
+    target = request_store()
+    if target is None:
+        return unknown_device()
+    return list_sms_by_cursor(target, request.args.get('sender'), request.args.get('exact') in ('1', 'true'))
+
+
+@app.route('/api/sms/search', methods=['GET'])
+@login_required
+def search_sms_web():
+    """全文检索短信（Web 界面）"""
+    return search_response()
+
+
 @app.route('/api/sms/delete', methods=['POST'])
 @login_required
 def delete_sms_batch():
-    """批量删除短信"""
+    """批量删除短信：按 ids，或按 sender / start / end / older_than_days 条件删除（同时给出时取交集）"""
     try:
         data = request.get_json()
-        ids = data.get('ids', [])
-        if not ids:
+        ids = data.get('ids')
+        sender = data.get('sender') or None
+        start = data.get('start') or None
+        end = data.get('end') or None
+        if data.get('older_than_days') is not None:
+            cutoff = datetime.now(CHINA_TZ) - timedelta(days=float(data['older_than_days']))
+            end = cutoff.strftime('%Y-%m-%d %H:%M:%S')
+        if not ids and not (sender or start or end):
             return jsonify({"status": "error", "message": "No IDs provided"}), 400
+        target = request_store(data.get('device'))
+        if target is None:
+            return unknown_device()
         
-        logs = load_logs()
-        original_len = len(logs)
-        logs = [l for l in logs if l.get('id') not in ids]
-        deleted = original_len - len(logs)
-        
-        save_logs(logs)
+        deleted = target.delete(ids or None, sender=sender, exact=bool(data.get('exact')), start=start, end=end)
         logger.info(f"批量删除 {deleted} 条短信")
         return jsonify({"status": "ok", "deleted": deleted})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
+EXPORT_FIELDS = ('id', 'sender', 'message', 'pdu_timestamp', 'received_at', 'client_ip', 'device')
+
+
+def export_json(records):
+    yield '['
+    for i, record in enumerate(records):
+        yield (',\n' if i else '\n') + json.dumps(record, ensure_ascii=False, indent=2)
+    yield '\n]'
+
+
+def export_ndjson(records):
+    for record in records:
+        yield json.dumps(record, ensure_ascii=False) + '\n'
+
+
+def export_csv(records):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(EXPORT_FIELDS)
+    yield '\ufeff' + buf.getvalue()  # BOM，方便 Excel 识别 UTF-8 中文
+    for record in records:
+        buf.seek(0)
+        buf.truncate()
+        writer.writerow([record.get(k, '') for k in EXPORT_FIELDS])
+        yield buf.getvalue()
+
+
+# 格式 -> (生成器, MIME 类型)
+EXPORT_FORMATS = {
+    'json': (export_json, 'application/json'),
+    'ndjson': (export_ndjson, 'application/x-ndjson'),
+    'csv': (export_csv, 'text/csv'),
+}
+
+
 @app.route('/api/sms/export', methods=['POST'])
 @login_required
 def export_sms():
-    """导出选中的短信为 JSON"""
+    """导出短信，支持 json / ndjson / csv 格式，边读边输出
+
+    请求体可选参数：ids（为空则导出全部）、format、sender、start、end（按接收时间过滤）、device
+    """
     try:
-        data = request.get_json()
-        ids = data.get('ids', [])
+        data = request.get_json(silent=True) or {}
+        fmt = data.get('format') or request.args.get('format', 'json')
+        if fmt not in EXPORT_FORMATS:
+            return jsonify({"status": "error", "message": f"Unsupported format: {fmt}"}), 400
+        generate, mimetype = EXPORT_FORMATS[fmt]
+        target = request_store(data.get('device'))
+        if target is None:
+            return unknown_device()
         
-        logs = load_logs()
-        if ids:
-            export_data = [l for l in logs if l.get('id') in ids]
-        else:
-            export_data = logs
-        
-        response = Response(
-            json.dumps(export_data, ensure_ascii=False, indent=2),
-            mimetype='application/json',
-            headers={'Content-Disposition': f'attachment;filename=sms_export_{get_china_time().replace(":", "-").replace(" ", "_")}.json'}
+        records = target.iter_records(
+            ids=data.get('ids') or None,
+            sender=data.get('sender'),
+            exact=bool(data.get('exact')),
+            start=data.get('start'),
+            end=data.get('end'),
+        )
+        filename = f'sms_export_{get_china_time().replace(":", "-").replace(" ", "_")}.{fmt}'
+        return Response(
+            generate(records),
+            mimetype=mimetype,
+            headers={'Content-Disposition': f'attachment;filename={filename}'}
         )
-        return response
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
@@ -230,21 +3220,62 @@ def export_sms():
 @app.route('/api/sms/clear', methods=['POST'])
 @login_required
 def clear_sms():
-    """清空所有短信"""
-    save_logs([])
+    """清空所有短信（device 参数只清空一台设备）"""
+    target = request_store()
+    if target is None:
+        return unknown_device()
+    target.clear()
     logger.info("已清空所有短信记录")
     return jsonify({"status": "ok"})
 
 
+@app.route('/api/stats', methods=['GET'])
+def sms_stats():
+    """短信统计（Web 会话或 API Key）：总数、发送者排行、按小时 / 天的条数、各设备的接收速率
+
+    由增量维护的计数表回答，耗时与桶数有关、与短信条数无关。
+    hours / days 为分桶范围（默认 24 小时、30 天），top 为返回的发送者个数，device 只统计一台设备。
+    """
+    if not session.get('logged_in') and not verify_api_key():
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    try:
+        hours = min(max(int(request.args.get('hours', 24)), 0), STATS_MAX_HOURS)
+        days = min(max(int(request.args.get('days', 30)), 0), STATS_MAX_DAYS)
+        top = min(max(int(request.args.get('top', 20)), 0), 1000)
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid hours, days or top"}), 400
+    target = request_store()
+    if target is None:
+        return unknown_device()
+    result = summarize_stats(target.stats_snapshots(), hours=hours, days=days, top=top)
+    return jsonify(dict({"status": "ok", "server_time": get_china_time()}, **result))
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 指标"""
+    if not verify_api_key():
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    queued, retries = forwarder.pending()
+    counts = [(p.count(), {'device': d}) for d, p in store.partitions.items()] or [(store.count(), {})]
+    gauges = [('sms_store_records', count, labels) for count, labels in counts] + [
+        ('sms_forward_queue_jobs', queued, {}),
+        ('sms_forward_retry_jobs', retries, {}),
+    ]
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """健康检查"""
-    logs = load_logs()
-    return jsonify({
+    result = {
         "status": "healthy",
-        "sms_count": len(logs),
+        "sms_count": store.count(),
         "server_time": get_china_time()
-    })
+    }
+    if store.partitions:
+        result["devices"] = {d: p.count() for d, p in store.partitions.items()}
+    return jsonify(result)
 
 
 # ==================== HTML 模板 ====================
@@ -326,6 +3357,11 @@ WEB_TEMPLATE = '''
         .checkbox { width: 18px; height: 18px; cursor: pointer; }
         .table-wrap { max-height: 600px; overflow-y: auto; }
         .search-box { padding: 8px 12px; border: 1px solid #ddd; border-radius: 4px; width: 200px; }
+        .code { display: inline-block; margin-right: 6px; padding: 1px 6px; border-radius: 4px;
+                background: #fff3cd; color: #856404; font-weight: 600; font-family: monospace; }
+        .device-select { padding: 8px 12px; border: 1px solid #ddd; border-radius: 4px; }
+        .device { display: inline-block; margin-left: 6px; padding: 1px 6px; border-radius: 4px;
+                  background: #eef3fb; color: #555; font-size: 12px; font-weight: normal; }
         .selected-count { color: #666; font-size: 14px; }
         .toast { position: fixed; top: 20px; right: 20px; padding: 12px 20px; background: #333; color: #fff;
                  border-radius: 6px; display: none; z-index: 1000; }
@@ -380,6 +3416,14 @@ WEB_TEMPLATE = '''
                 <div class="stat-value" id="totalCount">{{ total }}</div>
                 <div class="stat-label">总短信数</div>
             </div>
+            <div class="stat-item">
+                <div class="stat-value">{{ today }}</div>
+                <div class="stat-label">今日短信</div>
+            </div>
+            <div class="stat-item">
+                <div class="stat-value">{{ sender_count }}</div>
+                <div class="stat-label">发送者</div>
+            </div>
             <div class="stat-item">
                 <div class="stat-value">{{ server_time }}</div>
                 <div class="stat-label">服务器时间 (北京)</div>
@@ -390,7 +3434,13 @@ WEB_TEMPLATE = '''
     <div class="card">
         <div class="toolbar">
             <input type="text" class="search-box" id="searchInput" placeholder="搜索发送者或内容...">
-            <button class="btn btn-primary" onclick="location.reload()">🔄 刷新</button>
+            {% if devices %}
+            <select class="device-select" id="deviceSelect">
+                <option value="">全部设备</option>
+                {% for device in devices %}<option value="{{ device }}">{{ device }}</option>{% endfor %}
+            </select>
+            {% endif %}
+            <button class="btn btn-primary" onclick="reloadList()">🔄 刷新</button>
             <button class="btn btn-success" onclick="exportSelected()">📥 导出选中</button>
             <button class="btn btn-danger" onclick="deleteSelected()">🗑️ 删除选中</button>
             <button class="btn btn-secondary" onclick="selectAll()">☑️ 全选</button>
@@ -398,9 +3448,8 @@ WEB_TEMPLATE = '''
             <span class="selected-count">已选: <span id="selectedCount">0</span> 条</span>
         </div>
         
-        <div class="table-wrap">
-            {% if sms_list %}
-            <table id="smsTable">
+        <div class="table-wrap" id="tableWrap">
+            <table id="smsTable" style="display:none">
                 <thead>
                     <tr>
                         <th style="width:40px"><input type="checkbox" class="checkbox" id="checkAll" onchange="toggleAll(this)"></th>
@@ -410,27 +3459,21 @@ WEB_TEMPLATE = '''
                         <th>操作</th>
                     </tr>
                 </thead>
-                <tbody>
-                {% for sms in sms_list %}
-                    <tr data-id="{{ sms.id }}" data-sender="{{ sms.sender }}" data-message="{{ sms.message }}">
-                        <td><input type="checkbox" class="checkbox sms-check" value="{{ sms.id }}" onchange="updateCount()"></td>
-                        <td class="sender">{{ sms.sender }}</td>
-                        <td class="message">{{ sms.message }}</td>
-                        <td class="time">{{ sms.received_at }}</td>
-                        <td><button class="btn btn-danger" style="padding:4px 8px;font-size:12px" onclick="deleteOne({{ sms.id }})">删除</button></td>
-                    </tr>
-                {% endfor %}
-                </tbody>
+                <tbody></tbody>
             </table>
-            {% else %}
-            <div class="empty">暂无短信记录</div>
-            {% endif %}
+            <div class="empty" id="emptyTip" style="display:none">暂无短信记录</div>
+            <div class="empty" id="loadMore">加载中...</div>
         </div>
     </div>
 
     <div class="toast" id="toast"></div>
 
     <script>
+        const PAGE_SIZE = 50;
+        const tbody = document.querySelector('#smsTable tbody');
+        // 当前列表状态：最新列表按 id 游标翻页，搜索结果按 offset 翻页；device 为空时显示全部设备
+        const state = { keyword: '', device: '', cursor: '', offset: 0, hasMore: true, loading: false, generation: 0 };
+
         // 显示提示
         function showToast(msg, duration=2000) {
             const t = document.getElementById('toast');
@@ -439,23 +3482,90 @@ WEB_TEMPLATE = '''
             setTimeout(() => t.classList.remove('show'), duration);
         }
 
+        function escapeHtml(s) {
+            return String(s ?? '').replace(/[&<>"']/g, c => ({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'}[c]));
+        }
+        function renderRow(sms) {
+            return `<tr data-id="${sms.id}">
+                <td><input type="checkbox" class="checkbox sms-check" value="${sms.id}" onchange="updateCount()"></td>
+                <td class="sender">${escapeHtml(sms.sender)}${sms.device ? `<span class="device">${escapeHtml(sms.device)}</span>` : ''}</td>
+                <td class="message">${sms.code ? `<span class="code">${escapeHtml(sms.code)}</span>` : ''}${escapeHtml(sms.message)}</td>
+                <td class="time">${escapeHtml(sms.received_at)}</td>
+                <td><button class="btn btn-danger" style="padding:4px 8px;font-size:12px" onclick="deleteOne(${sms.id})">删除</button></td>
+            </tr>`;
+        }
+
         // 更新选中计数
         function updateCount() {
             const checked = document.querySelectorAll('.sms-check:checked').length;
             document.getElementById('selectedCount').textContent = checked;
         }
+        function updateEmpty() {
+            const empty = tbody.children.length === 0 && !state.hasMore;
+            document.getElementById('smsTable').style.display = tbody.children.length ? '' : 'none';
+            document.getElementById('emptyTip').style.display = empty ? '' : 'none';
+            document.getElementById('loadMore').style.display = state.hasMore ? '' : 'none';
+        }
+        function addTotal(delta) {
+            const total = document.getElementById('totalCount');
+            total.textContent = Math.max(parseInt(total.textContent) + delta, 0);
+        }
+
+        // 分页加载（滚动到底部时自动加载下一页）
+        async function loadMore() {
+            if (state.loading || !state.hasMore) return;
+            state.loading = true;
+            const generation = state.generation;
+            const device = state.device ? `&device=${encodeURIComponent(state.device)}` : '';
+            const url = (state.keyword
+                ? `/api/sms/search?limit=${PAGE_SIZE}&offset=${state.offset}&q=${encodeURIComponent(state.keyword)}`
+                : `/api/sms/list?limit=${PAGE_SIZE}&before_id=${state.cursor}`) + device;
+            try {
+                const res = await fetch(url);
+                const data = await res.json();
+                if (generation !== state.generation) return;
+                if (data.status !== 'ok') { showToast('加载失败: ' + data.message); state.hasMore = false; return; }
+                tbody.insertAdjacentHTML('beforeend', data.data.map(renderRow).join(''));
+                if (state.keyword) {
+                    state.offset += data.data.length;
+                    state.hasMore = state.offset < data.total;
+                } else {
+                    state.cursor = data.next_cursor ?? '';
+                    state.hasMore = data.has_more;
+                }
+            } finally {
+                if (generation === state.generation) {
+                    state.loading = false;
+                    updateEmpty();
+                    if (state.hasMore && isNearBottom()) loadMore();
+                }
+            }
+        }
+        function isNearBottom() {
+            const wrap = document.getElementById('tableWrap');
+            return wrap.scrollTop + wrap.clientHeight >= wrap.scrollHeight - 200;
+        }
+        function reloadList() {
+            state.generation++;
+            state.cursor = '';
+            state.offset = 0;
+            state.hasMore = true;
+            state.loading = false;
+            tbody.innerHTML = '';
+            document.getElementById('checkAll').checked = false;
+            updateCount();
+            updateEmpty();
+            loadMore();
+        }
+        document.getElementById('tableWrap').addEventListener('scroll', () => { if (isNearBottom()) loadMore(); });
 
-        // 全选/取消
+        // 全选/取消（作用于已加载的行）
         function toggleAll(el) {
-            document.querySelectorAll('.sms-check').forEach(cb => {
-                if (cb.closest('tr').style.display !== 'none') cb.checked = el.checked;
-            });
+            document.querySelectorAll('.sms-check').forEach(cb => cb.checked = el.checked);
             updateCount();
         }
         function selectAll() {
-            document.querySelectorAll('.sms-check').forEach(cb => {
-                if (cb.closest('tr').style.display !== 'none') cb.checked = true;
-            });
+            document.querySelectorAll('.sms-check').forEach(cb => cb.checked = true);
             document.getElementById('checkAll').checked = true;
             updateCount();
         }
@@ -470,6 +3580,15 @@ WEB_TEMPLATE = '''
             return Array.from(document.querySelectorAll('.sms-check:checked')).map(cb => parseInt(cb.value));
         }
 
+        // 删除后直接移除对应行，不再刷新整页
+        function removeRows(ids, deleted) {
+            ids.forEach(id => tbody.querySelectorAll(`tr[data-id="${id}"]`).forEach(tr => tr.remove()));
+            addTotal(-deleted);
+            updateEmpty();
+            updateCount();
+            if (isNearBottom()) loadMore();
+        }
+
         // 删除选中
         async function deleteSelected() {
             const ids = getSelectedIds();
@@ -484,7 +3603,7 @@ WEB_TEMPLATE = '''
             const data = await res.json();
             if (data.status === 'ok') {
                 showToast(`已删除 ${data.deleted} 条`);
-                setTimeout(() => location.reload(), 1000);
+                removeRows(ids, data.deleted);
             } else {
                 showToast('删除失败: ' + data.message);
             }
@@ -501,7 +3620,7 @@ WEB_TEMPLATE = '''
             const data = await res.json();
             if (data.status === 'ok') {
                 showToast('已删除');
-                setTimeout(() => location.reload(), 500);
+                removeRows([id], data.deleted);
             }
         }
 
@@ -525,37 +3644,193 @@ WEB_TEMPLATE = '''
             showToast(`已导出 ${ids.length} 条`);
         }
 
-        // 搜索过滤
+        // 搜索（服务端全文检索，覆盖全部历史短信）
+        let searchTimer = null;
         document.getElementById('searchInput').addEventListener('input', function() {
-            const keyword = this.value.toLowerCase();
-            document.querySelectorAll('#smsTable tbody tr').forEach(tr => {
-                const sender = tr.dataset.sender.toLowerCase();
-                const message = tr.dataset.message.toLowerCase();
-                tr.style.display = (sender.includes(keyword) || message.includes(keyword)) ? '' : 'none';
-            });
+            clearTimeout(searchTimer);
+            searchTimer = setTimeout(() => {
+                state.keyword = this.value.trim();
+                reloadList();
+            }, 250);
+        });
+
+        const deviceSelect = document.getElementById('deviceSelect');
+        if (deviceSelect) deviceSelect.addEventListener('change', function() {
+            state.device = this.value;
+            reloadList();
         });
+
+        // 通过 SSE 实时接收新短信（全部设备）；服务端连接数已满（503）时浏览器不会自动重连，稍后重新订阅
+        function subscribe() {
+            const source = new EventSource('/sms/stream');
+            source.addEventListener('sms', e => {
+                const sms = JSON.parse(e.data);
+                addTotal(1);
+                if (state.device && (sms.device || 'default') !== state.device) return;
+                if (state.keyword || tbody.querySelector(`tr[data-id="${sms.id}"]`)) return;
+                tbody.insertAdjacentHTML('afterbegin', renderRow(sms));
+                updateEmpty();
+            });
+            source.onerror = () => {
+                if (source.readyState === EventSource.CLOSED) setTimeout(subscribe, 10000);
+            };
+        }
+        subscribe();
+
+        loadMore();
     </script>
 </body>
 </html>
 '''
 
+# 模板在启动时编译一次
+LOGIN_PAGE = app.jinja_env.from_string(LOGIN_TEMPLATE)
+WEB_PAGE = app.jinja_env.from_string(WEB_TEMPLATE)
+
 
 @app.route('/', methods=['GET'])
 @login_required
 def web_index():
-    """Web 管理界面（需要登录）"""
-    logs = load_logs()[::-1][:100]
-    return render_template_string(
-        WEB_TEMPLATE,
-        sms_list=logs,
-        total=len(load_logs()),
+    """Web 管理界面（需要登录），只输出页面框架，短信列表由前端分页请求 /api/sms/list"""
+    summary = summarize_stats(store.stats_snapshots(), hours=0, days=1, top=0)
+    return render_template(
+        WEB_PAGE,
+        total=summary['total'],
+        today=summary['daily'][0]['count'],
+        sender_count=summary['sender_count'],
+        devices=list(store.partitions),
         server_time=get_china_time(),
         username=session.get('username', 'Guest')
     )
 
 
-if __name__ == '__main__':
+# ==================== 服务启动 ====================
+
+def start_background():
+    """启动后台维护与转发线程（多进程部署时在每个 worker 中调用）"""
+    store.start_compactor()
+    if FORWARD_WEBHOOKS:
+        forwarder.start()  # 尽早接管上次运行遗留的重试任务
+
+
+def shutdown():
+    """优雅退出：结束 SSE 与长轮询连接，把未转发的任务写入重试队列"""
+    logger.info("收到退出信号，正在结束推送连接...")
+    store.feed.close()
+    for part in store.partitions.values():
+        part.feed.close()
+    store.save_stats()
+    forwarder.drain()
+
+
+def serve_gunicorn(host, port, workers, threads):
+    """用 gunicorn（gthread）多进程运行；SIGTERM 时停止接收新连接，等待进行中的请求完成"""
+    from gunicorn.app.base import BaseApplication
+
+    def post_worker_init(worker):
+        handle_exit = signal.getsignal(signal.SIGTERM)
+
+        def on_sigterm(signum, frame):
+            shutdown()
+            handle_exit(signum, frame)
+
+        signal.signal(signal.SIGTERM, on_sigterm)
+        start_background()
+
+    class Server(BaseApplication):
+        def load_config(self):
+            options = {
+                'bind': f'{host}:{port}',
+                'workers': workers,
+                'worker_class': 'gthread',
+                'threads': threads,
+                'graceful_timeout': GRACEFUL_TIMEOUT,
+                'post_worker_init': post_worker_init,
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Server().run()
+
+
+def serve_waitress(host, port, threads):
+    """用 waitress 单进程多线程运行（不支持 fork 的平台）
+
+    SIGTERM 时关闭监听端口，等进行中的请求处理完（最长 GRACEFUL_TIMEOUT 秒）再退出。
+    """
+    from waitress import create_server, wasyncore
+
+    server = create_server(app, host=host, port=port, threads=threads)
+    dispatcher = server.task_dispatcher
+
+    def drain():
+        deadline = time.monotonic() + GRACEFUL_TIMEOUT
+        while time.monotonic() < deadline and (dispatcher.active_count or dispatcher.queue):
+            time.sleep(0.1)
+        time.sleep(0.5)  # 留给主循环写完最后的响应
+        os.kill(os.getpid(), signal.SIGINT)  # waitress 收到 KeyboardInterrupt 后关闭线程池退出
+
+    def on_sigterm(signum, frame):
+        shutdown()
+        wasyncore.dispatcher.close(server)  # 只关闭监听端口，已建立的连接继续处理
+        threading.Thread(target=drain, name='drain', daemon=True).start()
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+    start_background()
+    server.run()
+
+
+def serve_dev(host, port):
+    """Flask 开发服务器；SIGTERM 时结束推送连接后立即退出，不等待进行中的请求"""
+    def on_sigterm(signum, frame):
+        shutdown()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+    start_background()
+    app.run(host=host, port=port, debug=False, threaded=True)
+
+
+def run_server(server, host, port, workers, threads):
+    """按 server 选择运行方式；auto 时依次尝试 gunicorn、waitress，都未安装则使用 Flask 开发服务器"""
+    if server == 'auto':
+        server = next((name for name in ('gunicorn', 'waitress') if importlib.util.find_spec(name)), 'dev')
+    if server == 'gunicorn':
+        logger.info(f"使用 gunicorn 运行：{workers} 个进程 × {threads} 线程")
+        return serve_gunicorn(host, port, workers, threads)
+    if server == 'waitress':
+        logger.info(f"使用 waitress 运行：{threads} 线程")
+        return serve_waitress(host, port, threads)
+    logger.warning("使用 Flask 开发服务器运行，生产环境请安装 gunicorn 或 waitress")
+    serve_dev(host, port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SMS Receiver")
+    parser.add_argument('--import-json', metavar='FILE', help="把旧版 sms_log.json 导入当前存储后端后退出")
+    parser.add_argument('--server', choices=('auto', 'gunicorn', 'waitress', 'dev'), default=SERVER,
+                        help="运行方式（默认取配置 SERVER）")
+    parser.add_argument('--workers', type=int, default=WORKERS, help="gunicorn 工作进程数")
+    parser.add_argument('--threads', type=int, default=THREADS, help="每个工作进程的线程数")
+    args = parser.parse_args()
+
+    if args.import_json:
+        count = import_json_logs(args.import_json, store)
+        logger.info(f"已从 {args.import_json} 导入 {count} 条短信")
+        return
+
     logger.info(f"SMS Receiver 启动中... 监听 {HOST}:{PORT}")
     logger.info(f"API Key: {API_KEY[:8]}***" if API_KEY else "API Key: 未设置")
     logger.info(f"Web 登录: {WEB_USER}")
-    app.run(host=HOST, port=PORT, debug=False)
\ No newline at end of file
+    if store.compact():
+        logger.info("已整理上次运行遗留的数据")
+    if not app.secret_key:
+        app.secret_key = load_secret_key(os.path.join(os.path.dirname(os.path.abspath(__file__)), SECRET_KEY_FILE))
+    run_server(args.server, HOST, PORT, args.workers, args.threads)
+
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file